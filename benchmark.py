@@ -0,0 +1,249 @@
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import index
+
+
+# ---------------------------------------------------------------------------
+#              BENCHMARKS DE LAS RUTAS DE DATOS (SIN INTERFAZ)
+# ---------------------------------------------------------------------------
+# Uso:
+#   python benchmark.py                          # 1k, 100k y 1M ensayos, CSV y SQLite
+#   python benchmark.py --sizes 1000 --backends csv --output results.json
+#   python benchmark.py --baseline results.json  # falla si algo es más lento que la referencia
+DEFAULT_SIZES = [1000, 100000, 1000000]
+DEFAULT_PARTICIPANTS = 10000
+PROTOCOLS = ["CONTROL", "HIGH"]
+PAGE_SIZE = 15
+
+
+def generate_participants(count, rng):
+    participants = []
+    for i in range(count):
+        participants.append({
+            "Type": "General",
+            "First Name": f"First{i:05d}",
+            "Last Name": f"Last{i:05d}",
+            "Birth Date": f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(1950, 2005)}",
+            "Sex": rng.choice(["Male", "Female"]),
+        })
+    return participants
+
+
+def generate_dataset(directory, trials, participants, seed=0):
+    # Crea participants.json y time_data_collection.csv con el mismo formato que la aplicación
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    participants_file = os.path.join(directory, 'participants.json')
+    results_file = os.path.join(directory, 'time_data_collection.csv')
+    people = generate_participants(participants, rng)
+    index.write_json_atomic(participants_file, people)
+    names = [index.ParticipantRepository.display_name(person) for person in people]
+    with open(results_file, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(index.TRIAL_COLUMNS)
+        for _ in range(trials):
+            writer.writerow([rng.choice(names), rng.choice(PROTOCOLS), round(rng.uniform(20.0, 400.0), 2),
+                             rng.randint(6, 20), round(rng.uniform(60.0, 190.0), 1)])
+    return participants_file, results_file, people
+
+
+class BenchmarkRun:
+    def __init__(self):
+        self.results = []
+
+    def measure(self, backend, size, operation, function, repeat=1, ops=1, setup=None):
+        # Tiempo de pared de cada repetición; ops = operaciones por repetición.
+        # setup se ejecuta sin medir antes de cada repetición
+        times = []
+        for _ in range(repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        result = {
+            "backend": backend,
+            "trials": size,
+            "operation": operation,
+            "repeat": repeat,
+            "ops": ops,
+            "min_s": min(times),
+            "median_s": statistics.median(times),
+            "per_op_us": min(times) / ops * 1e6,
+        }
+        self.results.append(result)
+        print(f"{backend:7s} {size:>9d} {operation:28s} {result['median_s'] * 1000:12.3f} ms"
+              f" {result['per_op_us']:12.1f} us/op")
+        return result
+
+
+def run_size(run, backend, size, participants, work_directory, seed, skip_export):
+    directory = os.path.join(work_directory, f"{backend}_{size}")
+    start = time.perf_counter()
+    participants_file, results_file, people = generate_dataset(directory, size, participants, seed)
+    print(f"Dataset {size} trials / {participants} participants generated in {time.perf_counter() - start:.1f} s")
+    rng = random.Random(seed + 1)
+
+    opened = {}
+    def open_backend():
+        opened["storage"] = index.open_storage(directory, participants_file, results_file, backend)
+    run.measure(backend, size, "open_storage", open_backend)
+    storage = opened["storage"]
+    repository = storage.participants
+    trials = storage.trials
+
+    # Participantes
+    if backend == "csv":
+        def load_participants():
+            index.ParticipantRepository(participants_file).all()
+        run.measure(backend, size, "participants_load", load_participants, repeat=3)
+    lookups = [rng.choice(people) for _ in range(1000)]
+    def check_participant_duplicates():
+        for person in lookups:
+            repository.is_duplicate(person)
+    run.measure(backend, size, "participants_is_duplicate", check_participant_duplicates,
+                repeat=3, ops=len(lookups))
+    def find_by_name():
+        for person in lookups:
+            repository.find_by_name(index.ParticipantRepository.display_name(person))
+    run.measure(backend, size, "participants_find_by_name", find_by_name, repeat=3, ops=len(lookups))
+    new_people = generate_participants(participants + 20, random.Random(seed + 2))[participants:]
+    def add_participants():
+        for person in new_people:
+            repository.add(dict(person))
+    run.measure(backend, size, "participants_add", add_participants, ops=len(new_people))
+    def remove_participants():
+        for person in new_people:
+            repository.remove(person)
+    run.measure(backend, size, "participants_remove", remove_participants, ops=len(new_people))
+
+    # Comprobación de ensayo repetido antes de empezar (StopwatchApp.is_duplicate)
+    trial_lookups = [(index.ParticipantRepository.display_name(rng.choice(people)), rng.choice(PROTOCOLS))
+                     for _ in range(1000)]
+    def check_trial_duplicates():
+        for participant_id, protocol in trial_lookups:
+            trials.contains(participant_id, protocol)
+    run.measure(backend, size, "is_duplicate", check_trial_duplicates, repeat=3, ops=len(trial_lookups))
+
+    # Consulta paginada (view_data): primera página en frío, luego en caliente,
+    # filtrada y ordenada. Las consultas filtradas y ordenadas se miden sin la
+    # caché de consultas, como la primera vez que se abren en la interfaz
+    participant_filter = index.ParticipantRepository.display_name(rng.choice(people))
+    def first_page():
+        trials.count()
+        trials.page(0, PAGE_SIZE)
+    run.measure(backend, size, "view_data_first_page", first_page)
+    run.measure(backend, size, "view_data_page_warm", first_page, repeat=5)
+    def last_page():
+        total = trials.count()
+        trials.page(max(0, total - PAGE_SIZE), PAGE_SIZE)
+    run.measure(backend, size, "view_data_last_page", last_page, repeat=5)
+    def filtered_page():
+        trials.count(participant_filter, "HIGH")
+        trials.page(0, PAGE_SIZE, participant_filter, "HIGH")
+    run.measure(backend, size, "view_data_filtered", filtered_page, repeat=3, setup=trials.clear_cache)
+    def sorted_page():
+        trials.page(0, PAGE_SIZE, sort_column='Time (seconds)', descending=True)
+    run.measure(backend, size, "view_data_sorted", sorted_page, repeat=3, setup=trials.clear_cache)
+
+    # Guardar ensayos (save_record)
+    rows = [[participant_filter, rng.choice(PROTOCOLS), 123.45, 13, 150.0] for _ in range(100)]
+    def save_records():
+        for row in rows:
+            trials.append(row)
+    run.measure(backend, size, "save_record", save_records, ops=len(rows))
+
+    # Borrado (delete_data_record) y compactación
+    ids = [record_id for record_id, _ in trials.page(0, 101)]
+    run.measure(backend, size, "delete_record", lambda: trials.delete(ids[:1]))
+    run.measure(backend, size, "delete_records_100", lambda: trials.delete(ids[1:101]), ops=100)
+    run.measure(backend, size, "compact", trials.compact)
+
+    # Exportación a Excel
+    if not skip_export:
+        export_file = os.path.join(directory, 'export.xlsx')
+        def export():
+            exporter = index.ExcelExporter(storage, export_file)
+            exporter.start()
+            exporter.thread.join()
+            while True:
+                message = exporter.messages.get_nowait()
+                if message[0] == 'done':
+                    return
+                if message[0] in ('error', 'cancelled'):
+                    raise RuntimeError(f"Export failed: {message}")
+        run.measure(backend, size, "export_to_excel", export, ops=size)
+
+    storage.close()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def compare_with_baseline(results, baseline_file, tolerance):
+    # Devuelve las operaciones más lentas que la referencia por encima de la tolerancia
+    with open(baseline_file, 'r') as file:
+        baseline = json.load(file)
+    reference = {(r["backend"], r["trials"], r["operation"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        previous = reference.get((result["backend"], result["trials"], result["operation"]))
+        if previous and result["min_s"] > previous["min_s"] * tolerance:
+            regressions.append((result, previous))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the data paths of the time perception app.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="numbers of trials")
+    parser.add_argument('--participants', type=int, default=DEFAULT_PARTICIPANTS)
+    parser.add_argument('--backends', nargs='+', choices=['csv', 'sqlite'], default=['csv', 'sqlite'])
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="previous results file to compare with")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="maximum slowdown allowed against the baseline")
+    parser.add_argument('--skip-export', action='store_true', help="do not time the Excel export")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help="directory for the generated datasets (default: a temporary one)")
+    args = parser.parse_args(argv)
+
+    work_directory = args.work_dir or tempfile.mkdtemp(prefix='time_app_bench_')
+    run = BenchmarkRun()
+    try:
+        for size in args.sizes:
+            for backend in args.backends:
+                run_size(run, backend, size, args.participants, work_directory, args.seed, args.skip_export)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "participants": args.participants,
+        "results": run.results,
+    }
+    index.write_json_atomic(args.output, report)
+    print("Results saved to", args.output)
+
+    if args.baseline:
+        regressions = compare_with_baseline(run.results, args.baseline, args.tolerance)
+        for result, previous in regressions:
+            print(f"REGRESSION {result['backend']} {result['trials']} {result['operation']}: "
+                  f"{previous['min_s'] * 1000:.3f} ms -> {result['min_s'] * 1000:.3f} ms")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
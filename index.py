@@ -1,87 +1,3358 @@
 import tkinter as tk
 from tkinter import PhotoImage
 import time
+STARTUP_T0 = time.perf_counter()
+import bisect
 import csv
 import os
-import pygame
+import sys
 import json
-from tkinter import messagebox, simpledialog, ttk, Menu
-from PIL import Image, ImageTk, ImageSequence
-import pandas as pd
+import struct
+import random
+import sqlite3
+import tempfile
+import zlib
+from tkinter import filedialog, messagebox, simpledialog, ttk, Menu
+import numpy as np
+# pandas, openpyxl, bleak, pygame y PIL se importan al usarse por primera vez
+# (exportar, escanear, sonido, animación) para que la ventana aparezca antes
 
 # Librerías para BLE (para la conexión con el pulsómetro)
 import asyncio
 import threading
-from bleak import BleakClient, BleakScanner
+import queue
+from array import array
+from collections import deque
 
 # UUID estándar para el servicio y característica de Heart Rate en BLE
 HR_SERVICE_UUID = "0000180d-0000-1000-8000-00805f9b34fb"
 HR_MEASUREMENT_CHAR_UUID = "00002a37-0000-1000-8000-00805f9b34fb"
 
+# Supervisión de la conexión: sin notificaciones durante NOTIFICATION_TIMEOUT se
+# considera perdida la señal; los reintentos esperan de 1 s a 30 s (exponencial)
+NOTIFICATION_TIMEOUT = 5.0
+WATCHDOG_INTERVAL = 1.0
+RECONNECT_INITIAL_DELAY = 1.0
+RECONNECT_MAX_DELAY = 30.0
 
-class HeartRateMonitor:
-    def __init__(self, address):
+# Duración máxima de un escaneo y archivo con los pulsómetros ya usados
+SCAN_TIMEOUT = 15.0
+# Espera máxima al hilo BLE al cerrar la aplicación
+BLE_SHUTDOWN_TIMEOUT = 5.0
+KNOWN_DEVICES_FILENAME = 'known_devices.json'
+
+# Cabeceras de los archivos de resultados y de FC
+TRIAL_COLUMNS = ['Participant', 'Protocol', 'Time (seconds)', 'RPE', 'Mean HR', 'Stop Latency (ms)',
+                 'Cue Latency (ms)', 'Skipped HR Samples', 'Min HR', 'Max HR', 'HR SD',
+                 'Time Below Zone (s)', 'Time In Zone (s)', 'Time Above Zone (s)',
+                 'RMSSD (ms)', 'SDNN (ms)', 'pNN50 (%)', 'RR Mean HR', 'RR Artifacts']
+TRIAL_SQL_COLUMNS = ['participant', 'protocol', 'time_seconds', 'rpe', 'mean_hr', 'stop_latency_ms',
+                     'cue_latency_ms', 'skipped_hr_samples', 'min_hr', 'max_hr', 'hr_sd',
+                     'time_below_zone', 'time_in_zone', 'time_above_zone',
+                     'rmssd_ms', 'sdnn_ms', 'pnn50', 'rr_mean_hr', 'rr_artifacts']
+# Columnas que se muestran en las tablas; el resto son datos de auditoría de cada ensayo
+TRIAL_TABLE_COLUMNS = TRIAL_COLUMNS[:5]
+HR_COLUMNS = ['Protocol', 'Elapsed Time (s)', 'HR (bpm)']
+
+# Backend de almacenamiento: "csv" (archivos originales) o "sqlite"
+STORAGE_BACKEND = os.environ.get("TIME_APP_STORAGE", "csv")
+SQLITE_FILENAME = 'time_data.sqlite3'
+# Cada cuánto se comprueba si hay borrados pendientes de compactar
+IDLE_COMPACTION_INTERVAL_MS = 60000
+# Formato de las trazas de FC con el backend CSV: "csv" o "binary"
+HR_TRACE_FORMAT = os.environ.get("TIME_APP_HR_FORMAT", "csv")
+
+# Formato binario de trazas de FC: cabecera de 16 bytes seguida de registros de
+# ancho fijo (segmento, FC, tiempo transcurrido, protocolo). Cada ensayo es un
+# segmento nuevo, de modo que el archivo solo crece por el final.
+HR_TRACE_MAGIC = b'HRTRACE1'
+HR_TRACE_VERSION = 1
+HR_TRACE_HEADER = struct.Struct('<8sHH4x')
+HR_TRACE_RECORD = struct.Struct('<Ifd8s')
+HR_TRACE_DTYPE = np.dtype([('segment', '<u4'), ('hr', '<f4'), ('elapsed', '<f8'), ('protocol', 'S8')])
+
+# Bits del byte de flags de Heart Rate Measurement (GATT 0x2A37)
+HR_FLAG_UINT16 = 0x01
+HR_FLAG_CONTACT_DETECTED = 0x02
+HR_FLAG_CONTACT_SUPPORTED = 0x04
+HR_FLAG_ENERGY_EXPENDED = 0x08
+HR_FLAG_RR_INTERVAL = 0x10
+# Los intervalos RR se transmiten en unidades de 1/1024 s
+RR_UNITS_PER_SECOND = 1024.0
+
+_UINT16 = struct.Struct('<H')
+# Estructuras precompiladas para leer N intervalos RR de una vez
+_RR_STRUCTS = [struct.Struct(f'<{n}H') for n in range(11)]
+
+
+class HRSample:
+    # __slots__ para que cada muestra ocupe lo mínimo en sesiones largas
+    __slots__ = ('timestamp', 'hr', 'contact', 'energy', 'rr')
+
+    def __init__(self, timestamp, hr, contact=None, energy=None, rr=()):
+        self.timestamp = timestamp  # time.perf_counter() al recibir la notificación
+        self.hr = hr                # bpm
+        self.contact = contact      # None si el sensor no informa del contacto
+        self.energy = energy        # kJ acumulados, o None
+        self.rr = rr                # tupla de intervalos RR en unidades de 1/1024 s
+
+    @property
+    def rr_ms(self):
+        return tuple(v * 1000.0 / RR_UNITS_PER_SECOND for v in self.rr)
+
+    def __repr__(self):
+        return (f"HRSample(timestamp={self.timestamp:.3f}, hr={self.hr}, "
+                f"contact={self.contact}, energy={self.energy}, rr={self.rr})")
+
+
+def parse_hr_measurement(data, timestamp):
+    # Decodifica una notificación 0x2A37 completa. Se lee directamente del
+    # buffer recibido con unpack_from (sin slicing ni copias intermedias).
+    size = len(data)
+    if size < 2:
+        return None
+    flags = data[0]
+    if flags & HR_FLAG_UINT16:
+        if size < 3:
+            return None
+        hr = _UINT16.unpack_from(data, 1)[0]
+        offset = 3
+    else:
+        hr = data[1]
+        offset = 2
+    contact = None
+    if flags & HR_FLAG_CONTACT_SUPPORTED:
+        contact = bool(flags & HR_FLAG_CONTACT_DETECTED)
+    energy = None
+    if flags & HR_FLAG_ENERGY_EXPENDED:
+        if size < offset + 2:
+            return HRSample(timestamp, hr, contact)
+        energy = _UINT16.unpack_from(data, offset)[0]
+        offset += 2
+    rr = ()
+    if flags & HR_FLAG_RR_INTERVAL:
+        count = (size - offset) // 2
+        if count:
+            if count >= len(_RR_STRUCTS):
+                _RR_STRUCTS.extend(struct.Struct(f'<{n}H') for n in range(len(_RR_STRUCTS), count + 1))
+            rr = _RR_STRUCTS[count].unpack_from(data, offset)
+    return HRSample(timestamp, hr, contact, energy, rr)
+
+
+# ---------------------------------------------------------------------------
+#                    VARIABILIDAD DE LA FC (INTERVALOS RR)
+# ---------------------------------------------------------------------------
+# Los RR se tratan en unidades de 1/1024 s (enteros, como llegan del pulsómetro)
+# para que las sumas de la ventana deslizante no acumulen error al restar.
+HRV_WINDOW_SECONDS = 60.0
+HRV_RR_MIN_MS = 300
+HRV_RR_MAX_MS = 2000
+# Un latido que se aparta más de este porcentaje de la mediana de los últimos
+# HRV_REFERENCE_BEATS latidos (aceptados o no) es un artefacto; al usar también
+# los rechazados, un cambio sostenido de FC pasa a ser la referencia en 3 latidos
+HRV_ARTIFACT_TOLERANCE = 0.20
+HRV_REFERENCE_BEATS = 5
+# Un silencio más largo que este (o una desconexión) reinicia la ventana
+HRV_MAX_GAP_SECONDS = 5.0
+NN50_UNITS_X1000 = 50 * RR_UNITS_PER_SECOND
+
+
+class HRVSums:
+    # Sumas suficientes para RMSSD, SDNN, pNN50 y FC media; añadir o quitar un
+    # latido es O(1). diff es |RR - RR anterior| o None si el anterior se rechazó.
+    __slots__ = ('beats', 'rr_sum', 'rr_sq_sum', 'diffs', 'diff_sq_sum', 'nn50')
+
+    def __init__(self):
+        self.beats = 0
+        self.rr_sum = 0
+        self.rr_sq_sum = 0
+        self.diffs = 0
+        self.diff_sq_sum = 0
+        self.nn50 = 0
+
+    def add(self, rr, diff, sign=1):
+        self.beats += sign
+        self.rr_sum += sign * rr
+        self.rr_sq_sum += sign * rr * rr
+        if diff is not None:
+            self.diffs += sign
+            self.diff_sq_sum += sign * diff * diff
+            if diff * 1000 > NN50_UNITS_X1000:
+                self.nn50 += sign
+
+    def metrics(self):
+        to_ms = 1000.0 / RR_UNITS_PER_SECOND
+        result = {'beats': self.beats, 'rmssd': None, 'sdnn': None, 'pnn50': None, 'mean_hr': None}
+        if self.beats:
+            result['mean_hr'] = 60.0 * RR_UNITS_PER_SECOND * self.beats / self.rr_sum
+        if self.beats > 1:
+            variance = (self.rr_sq_sum - self.rr_sum * self.rr_sum / self.beats) / (self.beats - 1)
+            result['sdnn'] = max(variance, 0.0) ** 0.5 * to_ms
+        if self.diffs:
+            result['rmssd'] = (self.diff_sq_sum / self.diffs) ** 0.5 * to_ms
+            result['pnn50'] = 100.0 * self.nn50 / self.diffs
+        return result
+
+
+class HRVPhase(HRVSums):
+    # Acumulado desde el inicio de una fase (reposo o ensayo)
+    __slots__ = ('artifacts',)
+
+    def __init__(self):
+        super().__init__()
+        self.artifacts = 0
+
+    def metrics(self):
+        result = super().metrics()
+        result['artifacts'] = self.artifacts
+        return result
+
+
+class HRVEngine:
+    # Motor de HRV en streaming: filtra artefactos y mantiene una ventana
+    # deslizante de HRV_WINDOW_SECONDS en buffers circulares preasignados,
+    # además de los acumulados de las fases abiertas. Trabajo O(1) amortizado
+    # por latido; se alimenta desde el hilo BLE con los RR de cada notificación.
+    def __init__(self, window_seconds=HRV_WINDOW_SECONDS, capacity=256):
+        self.window_seconds = window_seconds
+        self.window_units = int(window_seconds * RR_UNITS_PER_SECOND)
+        self.capacity = capacity
+        self.rr = array('l', bytes(capacity * array('l').itemsize))
+        self.diffs = array('l', bytes(capacity * array('l').itemsize))
+        # Instante de llegada de cada latido, para vaciar la ventana por tiempo
+        self.times = array('d', bytes(capacity * array('d').itemsize))
+        self.artifacts = 0
+        self.phases = ()
+        self._min_units = HRV_RR_MIN_MS * RR_UNITS_PER_SECOND // 1000
+        self._max_units = HRV_RR_MAX_MS * RR_UNITS_PER_SECOND // 1000
+        self.reset()
+
+    def reset(self):
+        # Vacía la ventana y la referencia (hueco o desconexión); las fases
+        # abiertas conservan lo acumulado
+        self.head = 0
+        self.size = 0
+        self.window = HRVSums()
+        self.recent = deque(maxlen=HRV_REFERENCE_BEATS)
+        self._previous = None
+        self._last_time = None
+
+    def add_rr(self, intervals, timestamp=None):
+        if timestamp is not None:
+            if self._last_time is not None and timestamp - self._last_time > HRV_MAX_GAP_SECONDS:
+                self.reset()
+            self._last_time = timestamp
+            while self.size and self.times[self.head] < timestamp - self.window_seconds:
+                self._evict()
+        for rr in intervals:
+            self.add_beat(rr, timestamp)
+
+    def add_beat(self, rr, timestamp=None):
+        if not self._accept(rr):
+            self.artifacts += 1
+            for phase in self.phases:
+                phase.artifacts += 1
+            # La diferencia sucesiva no puede cruzar un artefacto
+            self._previous = None
+            return
+        diff = abs(rr - self._previous) if self._previous is not None else None
+        self._previous = rr
+        if self.size == self.capacity:
+            self._evict()
+        tail = (self.head + self.size) % self.capacity
+        self.rr[tail] = rr
+        self.diffs[tail] = -1 if diff is None else diff
+        self.times[tail] = time.perf_counter() if timestamp is None else timestamp
+        self.size += 1
+        self.window.add(rr, diff)
+        while self.window.rr_sum > self.window_units and self.size > 1:
+            self._evict()
+        for phase in self.phases:
+            phase.add(rr, diff)
+
+    def _accept(self, rr):
+        if not self._min_units <= rr <= self._max_units:
+            return False
+        recent = self.recent
+        accepted = True
+        if len(recent) == HRV_REFERENCE_BEATS:
+            reference = sorted(recent)[HRV_REFERENCE_BEATS // 2]
+            accepted = abs(rr - reference) <= HRV_ARTIFACT_TOLERANCE * reference
+        recent.append(rr)
+        return accepted
+
+    def _evict(self):
+        diff = self.diffs[self.head]
+        self.window.add(self.rr[self.head], None if diff < 0 else diff, -1)
+        self.head = (self.head + 1) % self.capacity
+        self.size -= 1
+
+    def window_metrics(self):
+        return self.window.metrics()
+
+    def start_phase(self):
+        phase = HRVPhase()
+        # Tupla nueva: el hilo BLE puede estar recorriendo la anterior
+        self.phases = self.phases + (phase,)
+        return phase
+
+    def end_phase(self, phase):
+        self.phases = tuple(p for p in self.phases if p is not phase)
+        return phase.metrics()
+
+
+def hrv_columns(metrics, prefix=''):
+    # Resumen de una fase con los nombres de columna de resultados/participantes
+    def rounded(value):
+        return round(value, 2) if value is not None else None
+    return {
+        f'{prefix}RMSSD (ms)': rounded(metrics['rmssd']),
+        f'{prefix}SDNN (ms)': rounded(metrics['sdnn']),
+        f'{prefix}pNN50 (%)': rounded(metrics['pnn50']),
+        f'{prefix}RR Mean HR': rounded(metrics['mean_hr']),
+        f'{prefix}RR Artifacts': metrics['artifacts'],
+    }
+
+
+# ---------------------------------------------------------------------------
+#                    INSTRUMENTACIÓN DE RENDIMIENTO
+# ---------------------------------------------------------------------------
+# Histogramas de duraciones (segundos) con cubos exponenciales de 50 µs a ~13 s.
+# observe() es seguro entre hilos y cuesta O(log cubos); el registro se puede
+# volcar a JSON o al formato de texto de Prometheus y se ve en la ventana de
+# diagnóstico (Ctrl+Shift+D). TIME_APP_METRICS_FILE guarda el volcado al salir.
+METRIC_BUCKETS = tuple(0.00005 * 2 ** i for i in range(19))
+METRICS_FILE = os.environ.get("TIME_APP_METRICS_FILE")
+
+
+class Histogram:
+    def __init__(self, name, labels=(), buckets=METRIC_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = buckets
+        # Un cubo más para los valores por encima del último límite
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        # Interpolación lineal dentro del cubo; el último cubo se acota con max
+        with self._lock:
+            counts = list(self.counts)
+            count, maximum = self.count, self.max
+        if not count:
+            return None
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                low = self.buckets[index - 1] if index else 0.0
+                high = self.buckets[index] if index < len(self.buckets) else maximum
+                return min(low + (high - low) * (rank - cumulative) / bucket_count, maximum)
+            cumulative += bucket_count
+        return maximum
+
+    def snapshot(self):
+        with self._lock:
+            counts, count, total, maximum = list(self.counts), self.count, self.sum, self.max
+        return {
+            "name": self.name,
+            "labels": dict(self.labels),
+            "count": count,
+            "sum": total,
+            "mean": total / count if count else None,
+            "max": maximum,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": [[bound, n] for bound, n in zip(self.buckets, counts)],
+            "overflow": counts[-1],
+        }
+
+
+class MetricTimer:
+    # with METRICS.time("file_op_seconds", op="save_record"): ...
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class MetricsRegistry:
+    HELP = {
+        "tk_loop_lag_seconds": "Delay between the scheduled and the actual firing of Tk timer jobs",
+        "tk_job_seconds": "Duration of the periodic jobs run on the Tk thread",
+        "hr_notification_interval_seconds": "Time between consecutive HR notifications of a source",
+        "hr_notification_handling_seconds": "Time spent handling one HR notification on the BLE thread",
+        "hr_sample_delivery_seconds": "Delay from an HR notification to its handling on the Tk thread",
+        "file_op_seconds": "Duration of file operations",
+        "tk_skipped_ticks_total": "Deadlines of periodic Tk jobs skipped because the job ran late",
+    }
+
+    def __init__(self):
+        self.histograms = {}
+        # Contadores acumulados: (nombre, etiquetas) -> valor
+        self.counters = {}
+        self.created = time.time()
+        self._lock = threading.Lock()
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram(name, key[1]))
+        return histogram
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def time(self, name, **labels):
+        return MetricTimer(self.histogram(name, **labels))
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self.created = time.time()
+
+    def _items(self):
+        # Copia bajo el lock: el hilo BLE puede crear histogramas mientras se recorren
+        with self._lock:
+            return sorted(self.histograms.items())
+
+    def snapshot(self):
+        return [histogram.snapshot() for _, histogram in self._items()]
+
+    def counter_snapshot(self):
+        with self._lock:
+            counters = sorted(self.counters.items())
+        return [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in counters]
+
+    def to_json(self):
+        return {"created": self.created, "exported": time.time(), "histograms": self.snapshot(),
+                "counters": self.counter_snapshot()}
+
+    def to_prometheus(self):
+        lines = []
+        counters = self.counter_snapshot()
+        for name in sorted({counter["name"] for counter in counters}):
+            lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for counter in counters:
+                if counter["name"] == name:
+                    labels = ",".join(f'{label}="{value}"' for label, value in counter["labels"].items())
+                    lines.append(f"{name}{{{labels}}} {counter['value']}" if labels else f"{name} {counter['value']}")
+        items = self._items()
+        for name in sorted({name for (name, _), _ in items}):
+            lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, histogram in items:
+                if key[0] != name:
+                    continue
+                snapshot = histogram.snapshot()
+                labels = ",".join(f'{label}="{value}"' for label, value in key[1])
+                cumulative = 0
+                for bound, count in snapshot["buckets"]:
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels + "," if labels else ""}le="{bound:.6g}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{labels + "," if labels else ""}le="+Inf"}} {snapshot["count"]}')
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{name}_sum{suffix} {snapshot['sum']:.9g}")
+                lines.append(f"{name}_count{suffix} {snapshot['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        # .prom/.txt en formato Prometheus, cualquier otra extensión en JSON
+        if os.path.splitext(filename)[1].lower() in ('.prom', '.txt'):
+            directory = os.path.dirname(filename) or '.'
+            fd, temp_path = tempfile.mkstemp(prefix='.metrics_', suffix='.tmp', dir=directory)
+            with os.fdopen(fd, 'w') as file:
+                file.write(self.to_prometheus())
+            os.replace(temp_path, filename)
+        else:
+            write_json_atomic(filename, self.to_json())
+
+
+METRICS = MetricsRegistry()
+
+
+# ---------------------------------------------------------------------------
+#                 ANILLO DE MUESTRAS ENTRE EL HILO BLE Y TK
+# ---------------------------------------------------------------------------
+SAMPLE_RING_CAPACITY = 4096
+
+
+class SampleRing:
+    # Buffer circular de un productor (hilo BLE) y varios consumidores (Tk):
+    # marca de tiempo monotónica, FC (NaN si no hay valor válido) y RR de cada
+    # notificación, con número de secuencia. El productor escribe la ranura y
+    # después publica la secuencia; cada consumidor lleva su propio cursor y
+    # detecta si el productor le ha adelantado (muestras perdidas).
+    def __init__(self, capacity=SAMPLE_RING_CAPACITY):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.hr = array('f', bytes(4 * capacity))
+        self.rr = [()] * capacity
+        # Número de muestras publicadas (la siguiente secuencia a escribir)
+        self.sequence = 0
+
+    def push(self, timestamp, hr, rr=()):
+        sequence = self.sequence
+        slot = sequence % self.capacity
+        self.timestamps[slot] = timestamp
+        self.hr[slot] = float('nan') if hr is None else hr
+        self.rr[slot] = rr
+        self.sequence = sequence + 1
+
+    def latest(self):
+        # (secuencia, timestamp, hr o None, rr) de la última muestra, o None
+        sequence = self.sequence - 1
+        if sequence < 0:
+            return None
+        sample = self._read(sequence)
+        return sample if self.sequence - self.capacity <= sequence else None
+
+    def _read(self, sequence):
+        slot = sequence % self.capacity
+        hr = self.hr[slot]
+        if hr != hr:
+            hr = None
+        elif hr.is_integer():
+            # Los pulsómetros envían bpm enteros: se devuelven como int para la
+            # etiqueta y los hr_data_*.csv
+            hr = int(hr)
+        return sequence, self.timestamps[slot], hr, self.rr[slot]
+
+    def cursor(self, from_start=False):
+        return SampleCursor(self, 0 if from_start else self.sequence)
+
+
+class SampleCursor:
+    def __init__(self, ring, position):
+        self.ring = ring
+        self.position = position
+        self.lost = 0
+
+    def read(self):
+        # Todas las muestras nuevas desde la última lectura
+        ring = self.ring
+        end = ring.sequence
+        start = max(self.position, end - ring.capacity)
+        samples = [ring._read(sequence) for sequence in range(start, end)]
+        # Las ranuras sobrescritas mientras se leían se descartan
+        oldest = min(ring.sequence - ring.capacity, end)
+        if oldest > start:
+            samples = samples[oldest - start:]
+            start = oldest
+        self.lost += start - self.position
+        self.position = end
+        return samples
+
+
+UI_WAKE_INTERVAL = 0.05
+
+
+class UIWaker:
+    # Avisa al hilo de Tk de que hay muestras nuevas. notify() solo levanta una
+    # bandera: el hilo BLE nunca llama a Tk, porque con Tcl multihilo
+    # event_generate espera al hilo de Tk y, si este está esperando al hilo BLE
+    # (al salir o al desconectar), ambos se bloquean. El hilo de Tk consulta la
+    # bandera cada poll_interval y varias notificaciones se agrupan en una.
+    def __init__(self, callback, scheduler, poll_interval=UI_WAKE_INTERVAL):
+        self.callback = callback
+        self.pending = False
+        scheduler.add('hr_samples', poll_interval, self._poll)
+
+    def notify(self):
+        self.pending = True
+
+    def _poll(self, scheduled, now):
+        if self.pending:
+            # Se baja antes de leer para no perder lo que llegue durante callback
+            self.pending = False
+            self.callback()
+
+
+class HRSource:
+    # Base común de las fuentes de FC (pulsómetro BLE, simulador, reproducción).
+    # Cada fuente es una corrutina run() que se ejecuta en el bucle compartido
+    # del BLEManager y entrega las notificaciones a notification_handler.
+
+    # Estados de la conexión que se muestran en la interfaz
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+    NO_SIGNAL = "no signal"
+    RECONNECTING = "reconnecting"
+    DISCONNECTED = "disconnected"
+
+    def __init__(self, address, manager=None, name=None):
         self.address = address
-        self.current_hr = 0
+        self.name = name
+        # Todas las fuentes comparten el bucle del BLEManager
+        self.manager = manager or get_ble_manager()
+        # None mientras no haya una lectura válida y reciente (nunca se congela el último valor)
+        self.current_hr = None
+        self.last_sample = None
+        self.sample_listeners = []
+        # Flujo de muestras de esta fuente para el hilo de Tk
+        self.ring = SampleRing()
+        # HRV a partir de los intervalos RR de este dispositivo
+        self.hrv = HRVEngine()
+        self.state = self.DISCONNECTED
+        self.reconnects = 0
+        self.future = None
+        self.running = False
+        self._stop_event = None
+        self._last_notification = 0.0
+        # Llegada de la notificación anterior, para los intervalos entre notificaciones
+        self._last_arrival = None
+
+    def add_sample_listener(self, callback):
+        # El callback se ejecuta en el hilo BLE con cada HRSample recibida
+        self.sample_listeners.append(callback)
+
+    def remove_sample_listener(self, callback):
+        if callback in self.sample_listeners:
+            self.sample_listeners.remove(callback)
+
+    def notification_handler(self, sender, data: bytearray):
+        arrival = time.perf_counter()
+        sample = parse_hr_measurement(data, arrival)
+        if sample is None:
+            return
+        source = type(self).__name__
+        if self._last_arrival is not None:
+            METRICS.observe("hr_notification_interval_seconds", arrival - self._last_arrival, source=source)
+        self._last_notification = self._last_arrival = arrival
+        if self.state != self.CONNECTED:
+            self.state = self.CONNECTED
+        # Sin contacto con la piel el valor no es fiable
+        self.current_hr = None if sample.contact is False else sample.hr
+        if sample.rr and sample.contact is not False:
+            self.hrv.add_rr(sample.rr, sample.timestamp)
+        self._publish(sample)
+        METRICS.observe("hr_notification_handling_seconds", time.perf_counter() - arrival, source=source)
+
+    def _publish(self, sample):
+        self.last_sample = sample
+        self.ring.push(sample.timestamp, None if sample.contact is False else sample.hr, sample.rr)
+        for callback in self.sample_listeners:
+            callback(sample)
+        self.manager.wake()
+
+    def _mark_gap(self, state):
+        # Marca explícita de hueco: FC desconocida hasta la próxima notificación
+        self.state = state
+        # Los RR de antes del hueco no sirven de referencia para los siguientes
+        self.hrv.reset()
+        if self.current_hr is not None or (self.last_sample and self.last_sample.hr is not None):
+            self.current_hr = None
+            self._publish(HRSample(time.perf_counter(), None))
+
+    async def _wait_for_stop(self, timeout):
+        # True si se ha pedido parar antes de que pase timeout
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def run(self):
+        raise NotImplementedError
+
+    def start(self):
+        self.running = True
+        self.future = self.manager.submit(self._run_with_stop_event())
+        self.future.add_done_callback(self._on_finished)
+
+    async def _run_with_stop_event(self):
+        self._stop_event = asyncio.Event()
+        if self.running:
+            await self.run()
+        self._mark_gap(self.DISCONNECTED)
+
+    def _on_finished(self, future):
+        if not future.cancelled() and future.exception():
+            print("Error en la conexión con", self.address, ":", future.exception())
+        self.running = False
+        self.state = self.DISCONNECTED
+        self.current_hr = None
+
+    def _signal_stop(self):
+        # Se ejecuta dentro del bucle BLE
+        if self._stop_event:
+            self._stop_event.set()
+
+    def stop(self, timeout=10.0):
+        # Pide a run() que termine dentro del bucle, en lugar de parar el bucle compartido
+        self.running = False
+        if self.future is None:
+            return
+        self.manager.call_soon(self._signal_stop)
+        try:
+            self.future.result(timeout)
+        except Exception:
+            pass
+        self.future = None
+
+
+class HeartRateMonitor(HRSource):
+    # Pulsómetro BLE real a través de Bleak
+    async def run(self):
+        # Supervisor de la conexión: reconecta con espera exponencial tras una
+        # desconexión o si dejan de llegar notificaciones
+        from bleak import BleakClient
+        delay = RECONNECT_INITIAL_DELAY
+        while self.running:
+            self.state = self.CONNECTING if not self.reconnects else self.RECONNECTING
+            disconnected = asyncio.Event()
+            try:
+                async with BleakClient(self.address, disconnected_callback=lambda _: disconnected.set()) as client:
+                    print("Conectado a:", self.address)
+                    self._last_notification = time.perf_counter()
+                    await client.start_notify(HR_MEASUREMENT_CHAR_UUID, self.notification_handler)
+                    while self.running and not disconnected.is_set():
+                        await self._wait_for_stop(WATCHDOG_INTERVAL)
+                        if time.perf_counter() - self._last_notification > NOTIFICATION_TIMEOUT:
+                            print("Sin notificaciones de", self.address)
+                            self._mark_gap(self.NO_SIGNAL)
+                            break
+                        if self.state == self.CONNECTED:
+                            delay = RECONNECT_INITIAL_DELAY
+                    if client.is_connected:
+                        await client.stop_notify(HR_MEASUREMENT_CHAR_UUID)
+            except Exception as error:
+                print("Error en la conexión con", self.address, ":", error)
+            print("Desconectado de:", self.address)
+            if not self.running:
+                break
+            self._mark_gap(self.RECONNECTING)
+            self.reconnects += 1
+            await self._wait_for_stop(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+
+def build_hr_measurement(buffer, hr, rr=(), contact=True):
+    # Codifica una notificación 0x2A37 en buffer (bytearray reutilizable) y
+    # devuelve su longitud; es lo inverso de parse_hr_measurement
+    hr = int(round(hr))
+    flags = HR_FLAG_CONTACT_SUPPORTED | (HR_FLAG_CONTACT_DETECTED if contact else 0)
+    if rr:
+        flags |= HR_FLAG_RR_INTERVAL
+    if hr > 255:
+        flags |= HR_FLAG_UINT16
+        _UINT16.pack_into(buffer, 1, hr)
+        offset = 3
+    else:
+        buffer[1] = hr
+        offset = 2
+    buffer[0] = flags
+    for value in rr:
+        _UINT16.pack_into(buffer, offset, int(value))
+        offset += 2
+    return offset
+
+
+class SimulatedHRSource(HRSource):
+    # Pulsómetro sintético para pruebas de carga sin radio: FC con paseo
+    # aleatorio alrededor de base_hr, rate notificaciones por segundo con
+    # jitter, y cortes aleatorios de dropout_duration segundos
+    def __init__(self, address, manager=None, name=None, base_hr=75.0, rate=1.0, jitter=0.05,
+                 dropout_probability=0.0, dropout_duration=3.0, seed=None):
+        super().__init__(address, manager, name or address)
+        self.base_hr = base_hr
+        self.rate = rate
+        self.jitter = jitter
+        self.dropout_probability = dropout_probability
+        self.dropout_duration = dropout_duration
+        self.random = random.Random(seed)
+        self._buffer = bytearray(32)
+
+    async def run(self):
+        hr = self.base_hr
+        period = 1.0 / self.rate
+        next_time = time.perf_counter()
+        while self.running:
+            # Probabilidad de corte expresada por segundo
+            if self.dropout_probability and self.random.random() < self.dropout_probability * period:
+                self._mark_gap(self.NO_SIGNAL)
+                if await self._wait_for_stop(self.dropout_duration):
+                    break
+                next_time = time.perf_counter()
+            hr += (self.base_hr - hr) * 0.05 + self.random.gauss(0.0, 1.0)
+            hr = min(max(hr, 35.0), 230.0)
+            rr = (RR_UNITS_PER_SECOND * 60.0 / hr,)
+            size = build_hr_measurement(self._buffer, hr, rr)
+            self.notification_handler(self.address, memoryview(self._buffer)[:size])
+            next_time += period
+            delay = next_time - time.perf_counter() + self.random.uniform(-self.jitter, self.jitter) * period
+            if await self._wait_for_stop(max(0.0, delay)):
+                break
+
+
+class ReplayHRSource(HRSource):
+    # Reproduce un hr_data_*.csv (o hr_trace_*.bin) a velocidad real o
+    # acelerada; las celdas vacías se reproducen como huecos
+    def __init__(self, filename, manager=None, name=None, speed=1.0, protocol=None, loop=False):
+        stem = os.path.splitext(os.path.basename(filename))[0]
+        super().__init__(f"REPLAY-{stem}", manager, name or stem)
+        self.filename = filename
+        self.speed = speed
+        self.protocol = protocol
+        self.loop = loop
+        self._buffer = bytearray(32)
+
+    def _rows(self):
+        if self.filename.endswith('.bin'):
+            return iter_hr_trace(self.filename)
+        return iter_hr_csv(self.filename)
+
+    async def run(self):
+        while self.running:
+            start = time.perf_counter()
+            # Los ensayos se encadenan uno detrás de otro en la línea de tiempo
+            offset = 0.0
+            previous_end = 0.0
+            last_protocol = None
+            last_elapsed = 0.0
+            for protocol, elapsed, hr in self._rows():
+                if self.protocol and protocol != self.protocol:
+                    continue
+                if _starts_new_segment(last_protocol, last_elapsed, protocol, elapsed):
+                    offset = previous_end + 1.0 - elapsed
+                last_protocol = protocol
+                last_elapsed = elapsed
+                previous_end = offset + elapsed
+                delay = start + (offset + elapsed) / self.speed - time.perf_counter()
+                if delay > 0 and await self._wait_for_stop(delay):
+                    return
+                if not self.running:
+                    return
+                if hr is None or hr != hr:
+                    self._mark_gap(self.NO_SIGNAL)
+                else:
+                    size = build_hr_measurement(self._buffer, hr)
+                    self.notification_handler(self.address, memoryview(self._buffer)[:size])
+            if not self.loop:
+                return
+
+
+class BLEManager:
+    # Un único hilo con un bucle asyncio para todas las conexiones BLE y los
+    # escaneos; los dispositivos se añaden y retiran mientras el bucle sigue vivo
+    def __init__(self):
         self.loop = None
         self.thread = None
-        self.running = False
+        self.monitors = {}
+        # Funciones que despiertan a los consumidores al llegar una muestra
+        self.wakers = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self.thread = threading.Thread(target=self._run_loop, args=(ready,), daemon=True)
+            self.thread.start()
+            ready.wait()
+
+    def _run_loop(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(ready.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def submit(self, coroutine):
+        # Programa una corrutina en el bucle BLE y devuelve un concurrent.futures.Future
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def add_waker(self, waker):
+        self.wakers.append(waker)
+
+    def wake(self):
+        for waker in self.wakers:
+            waker()
+
+    def call_soon(self, callback, *args):
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def start_scan(self, callback, timeout=SCAN_TIMEOUT):
+        # Escaneo continuo: callback(device, advertisement_data) se llama en el
+        # hilo BLE con cada anuncio recibido
+        scan = BLEScan(callback, timeout)
+        scan.future = self.submit(scan.run())
+        scan.manager = self
+        return scan
+
+    def add_device(self, address, name=None):
+        # Devuelve el monitor existente si el dispositivo ya está conectado
+        monitor = self.monitors.get(address)
+        if monitor and monitor.running:
+            return monitor
+        return self.add_source(HeartRateMonitor(address, manager=self, name=name))
+
+    def add_source(self, source):
+        # Registra y arranca cualquier HRSource (BLE, simulada o reproducción)
+        previous = self.monitors.get(source.address)
+        if previous and previous is not source:
+            previous.stop()
+        source.manager = self
+        self.monitors[source.address] = source
+        source.start()
+        return source
+
+    def remove_device(self, address):
+        monitor = self.monitors.pop(address, None)
+        if monitor:
+            monitor.stop()
+
+    def devices(self):
+        return list(self.monitors.values())
+
+    def shutdown(self):
+        # Primero se avisa a todas las conexiones y luego se espera a cada una
+        monitors = list(self.monitors.values())
+        self.monitors = {}
+        for monitor in monitors:
+            monitor.running = False
+            self.call_soon(monitor._signal_stop)
+        for monitor in monitors:
+            monitor.stop()
+        if self.loop and self.thread and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            # El hilo es daemon: si no termina a tiempo no impide salir
+            self.thread.join(BLE_SHUTDOWN_TIMEOUT)
+        self.loop = None
+        self.thread = None
+
+
+class BLEScan:
+    def __init__(self, callback, timeout):
+        self.callback = callback
+        self.timeout = timeout
+        self.manager = None
+        self.future = None
+        self.stopped = False
+        self._stop_event = None
+
+    async def run(self):
+        self._stop_event = asyncio.Event()
+        if self.stopped:
+            return
+        from bleak import BleakScanner
+        async with BleakScanner(detection_callback=self.callback):
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _signal_stop(self):
+        if self._stop_event:
+            self._stop_event.set()
+
+    def stop(self):
+        self.stopped = True
+        if self.manager:
+            self.manager.call_soon(self._signal_stop)
+
+    def done(self):
+        return self.future is None or self.future.done()
+
+
+def advertises_heart_rate(advertisement_data):
+    return HR_SERVICE_UUID in (uuid.lower() for uuid in (advertisement_data.service_uuids or ()))
+
+
+class KnownDeviceCache:
+    # Pulsómetros ya utilizados (known_devices.json), del más reciente al más antiguo
+    def __init__(self, filename):
+        self.filename = filename
+        self.devices = []
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r') as file:
+                    self.devices = json.load(file)
+            except (OSError, ValueError) as error:
+                print("No se pudo leer", filename, ":", error)
+
+    def remember(self, address, name=None):
+        self.devices = [device for device in self.devices if device.get("address") != address]
+        self.devices.insert(0, {"address": address, "name": name, "last_used": time.strftime('%Y-%m-%d %H:%M:%S')})
+        write_json_atomic(self.filename, self.devices)
+
+    def last_used(self):
+        return self.devices[0] if self.devices else None
+
+    def is_known(self, address):
+        return any(device.get("address") == address for device in self.devices)
+
+
+_ble_manager = None
+
+
+def get_ble_manager():
+    # BLEManager compartido por toda la aplicación
+    global _ble_manager
+    if _ble_manager is None:
+        _ble_manager = BLEManager()
+    return _ble_manager
+
+
+class HRLogWriter:
+    # Escritor en segundo plano para los archivos hr_data_*.csv. Las filas se
+    # encolan desde el hilo de Tk sin tocar el disco y un hilo dedicado las
+    # escribe por lotes (por tamaño, por tiempo o al pedir flush()).
+    def __init__(self, filename, participant=None, max_queue=10000, batch_size=60, flush_interval=5.0):
+        self.filename = filename
+        self.participant = participant
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, row):
+        # Nunca bloquea: si la cola está llena la fila se descarta y se contabiliza
+        try:
+            self.queue.put_nowait(row)
+            return True
+        except queue.Full:
+            self._count_dropped(1)
+            return False
+
+    def flush(self):
+        # Pide al hilo que vuelque lo pendiente sin esperar a que termine
+        self._flush_event.set()
+
+    def take_dropped(self):
+        # Devuelve las filas perdidas desde la última consulta y reinicia el contador
+        with self._dropped_lock:
+            dropped = self.dropped
+            self.dropped = 0
+        return dropped
+
+    def close(self, timeout=5.0):
+        self._stop_event.set()
+        self._flush_event.set()
+        self.thread.join(timeout)
+
+    def _count_dropped(self, count):
+        with self._dropped_lock:
+            self.dropped += count
+
+    def _run(self):
+        pending = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            stopping = self._stop_event.is_set()
+            try:
+                timeout = 0 if stopping else max(0.0, min(deadline - time.monotonic(), 0.25))
+                pending.append(self.queue.get(timeout=timeout))
+                # Recoge de golpe todo lo que ya esté en cola
+                while len(pending) < self.batch_size:
+                    pending.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            flush_requested = self._flush_event.is_set()
+            if pending and (len(pending) >= self.batch_size or flush_requested or stopping
+                            or time.monotonic() >= deadline):
+                with METRICS.time("file_op_seconds", op="hr_log_write"):
+                    self._write_rows(pending)
+                pending = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval
+            if flush_requested and self.queue.empty():
+                self._flush_event.clear()
+            if stopping and self.queue.empty() and not pending:
+                break
+        self._close()
+
+    def _write_rows(self, rows):
+        try:
+            with open(self.filename, 'a', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file, delimiter=';')
+                writer.writerows(rows)
+        except OSError as error:
+            print("Error escribiendo", self.filename, ":", error)
+            self._count_dropped(len(rows))
+
+    def _close(self):
+        pass
+
+
+def file_signature(path):
+    # (mtime en ns, tamaño) o None si el archivo no existe
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def write_json_atomic(filename, data):
+    # Escribe en un temporal del mismo directorio y lo renombra sobre el destino
+    directory = os.path.dirname(filename) or '.'
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '_', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, filename)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class ParticipantRepository:
+    # Mantiene participants.json en memoria con índices hash. El archivo solo
+    # se vuelve a leer si cambia en disco (mtime/tamaño) y se escribe de forma
+    # atómica (archivo temporal + rename).
+    def __init__(self, filename):
+        self.filename = filename
+        self.participants = []
+        self.by_key = {}
+        self.by_name = {}
+        self._signature = None
+
+    @staticmethod
+    def key_of(participant):
+        return (participant.get("First Name"), participant.get("Last Name"), participant.get("Birth Date"))
+
+    @staticmethod
+    def display_name(participant):
+        return f"{participant.get('First Name', '')} {participant.get('Last Name', '')}"
+
+    def refresh(self):
+        signature = file_signature(self.filename)
+        if signature == self._signature:
+            return
+        if signature is None:
+            participants = []
+        else:
+            with open(self.filename, 'r') as file:
+                participants = json.load(file)
+        self.participants = participants
+        self._signature = signature
+        self._rebuild_indexes()
+
+    def _rebuild_indexes(self):
+        self.by_key = {}
+        self.by_name = {}
+        for participant in self.participants:
+            self._index(participant)
+
+    def _index(self, participant):
+        # Si hay repetidos se conserva el primero, igual que la búsqueda lineal original
+        self.by_key.setdefault(self.key_of(participant), participant)
+        self.by_name.setdefault(self.display_name(participant), participant)
+
+    def exists(self):
+        return file_signature(self.filename) is not None
+
+    def all(self):
+        # Lista compartida: los llamadores no deben modificarla
+        self.refresh()
+        return self.participants
+
+    def find(self, first_name, last_name, birth_date):
+        self.refresh()
+        return self.by_key.get((first_name, last_name, birth_date))
+
+    def find_by_name(self, name):
+        self.refresh()
+        return self.by_name.get(name)
+
+    def is_duplicate(self, participant_info):
+        existing = self.find(participant_info["First Name"], participant_info["Last Name"],
+                             participant_info["Birth Date"])
+        return existing is not None and existing.get("Sex") == participant_info.get("Sex")
+
+    def add(self, participant_info):
+        self.refresh()
+        self.participants.append(participant_info)
+        self._index(participant_info)
+        self.save()
+
+    def update(self, participant_record, **fields):
+        participant = self.find(*self.key_of(participant_record))
+        if participant is None:
+            return None
+        participant.update(fields)
+        self.save()
+        return participant
+
+    def remove(self, participant_record):
+        self.refresh()
+        key = self.key_of(participant_record)
+        for i, participant in enumerate(self.participants):
+            if participant is participant_record or self.key_of(participant) == key:
+                del self.participants[i]
+                break
+        else:
+            return False
+        self._rebuild_indexes()
+        self.save()
+        return True
+
+    def save(self):
+        with METRICS.time("file_op_seconds", op="participants_write"):
+            write_json_atomic(self.filename, self.participants)
+        self._signature = file_signature(self.filename)
+
+
+def parse_trial_line(line):
+    # Una línea (bytes) del CSV de resultados; split directo salvo si hay comillas
+    text = line.decode('utf-8').rstrip('\r\n')
+    if '"' in text:
+        return next(csv.reader([text], delimiter=';'), [])
+    return text.split(';') if text else []
+
+
+def _sort_value(value):
+    # Ordena primero los valores numéricos, luego el texto y al final los vacíos
+    if value is None or value == '':
+        return (2, 0.0, '')
+    try:
+        return (0, float(value), '')
+    except (TypeError, ValueError):
+        return (1, 0.0, str(value))
+
+
+def _line_checksum(line):
+    return zlib.crc32(line.rstrip(b'\r\n'))
+
+
+def pad_trial_row(row):
+    # Las filas anteriores a una columna nueva son más cortas: se completan con vacíos
+    row = list(row[:len(TRIAL_COLUMNS)])
+    row.extend([''] * (len(TRIAL_COLUMNS) - len(row)))
+    return row
+
+
+class TrialIndex:
+    # Índice en memoria de time_data_collection.csv: desplazamiento en bytes de
+    # cada fila viva, su participante y protocolo, y el recuento de cada par
+    # (participante, protocolo). Las filas borradas se anotan como lápidas
+    # (desplazamiento + CRC32 de la línea) en un archivo aparte y se ocultan al
+    # leer; una lápida cuya línea ya no coincide (p. ej. tras compactar) se ignora.
+    def __init__(self, filename):
+        self.filename = filename
+        self.tombstone_filename = filename + '.deleted'
+        self.counts = {}
+        self.offsets = array('q')
+        self.participants = []
+        self.protocols = []
+        # Posiciones borradas desde la última carga: se marcan en vez de
+        # reconstruir los arrays; la compactación (o recargar) las elimina
+        self.removed = set()
+        self.removed_sorted = []
+        self.deleted = 0
+        self.signature = None
+
+    def _current_signature(self):
+        return (file_signature(self.filename), file_signature(self.tombstone_filename))
+
+    def _load_tombstones(self):
+        tombstones = {}
+        if os.path.exists(self.tombstone_filename):
+            with open(self.tombstone_filename, 'r', encoding='utf-8') as file:
+                for line in file:
+                    offset, _, checksum = line.strip().partition(';')
+                    if checksum:
+                        tombstones[int(offset)] = int(checksum)
+        return tombstones
+
+    def refresh(self):
+        signature = self._current_signature()
+        if signature == self.signature:
+            return
+        self.counts = {}
+        self.offsets = array('q')
+        self.participants = []
+        self.protocols = []
+        self.removed = set()
+        self.removed_sorted = []
+        self.deleted = 0
+        if signature[0] is not None:
+            tombstones = self._load_tombstones()
+            with open(self.filename, 'rb') as file:
+                position = len(file.readline())  # Saltamos cabecera
+                for line in file:
+                    if tombstones.get(position) == _line_checksum(line):
+                        self.deleted += 1
+                    else:
+                        row = parse_trial_line(line)
+                        if len(row) > 1:
+                            self._add(position, row[0], row[1])
+                    position += len(line)
+        self.signature = signature
+
+    def invalidate(self):
+        self.signature = None
+
+    def _add(self, offset, participant_id, protocol):
+        # Los nombres se internan para no guardar una copia por fila
+        participant_id = sys.intern(participant_id)
+        protocol = sys.intern(protocol)
+        self.offsets.append(offset)
+        self.participants.append(participant_id)
+        self.protocols.append(protocol)
+        key = (participant_id, protocol)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def __len__(self):
+        return len(self.offsets) - len(self.removed)
+
+    def live_positions(self):
+        return LivePositions(len(self.offsets), self.removed, self.removed_sorted)
+
+    def position_of(self, offset):
+        # Posición de una fila viva a partir de su desplazamiento, o None
+        position = bisect.bisect_left(self.offsets, offset)
+        if position < len(self.offsets) and self.offsets[position] == offset and position not in self.removed:
+            return position
+        return None
+
+    def contains(self, participant_id, protocol):
+        self.refresh()
+        return (participant_id, protocol) in self.counts
+
+    def add(self, offset, participant_id, protocol):
+        # Llamar justo después de añadir la fila al CSV en la posición offset
+        self._add(offset, participant_id, protocol)
+        self.signature = self._current_signature()
+
+    def remove(self, positions):
+        # Llamar justo después de escribir las lápidas; O(k) para k filas (más
+        # la inserción ordenada), sin tocar los arrays del índice
+        for position in positions:
+            key = (self.participants[position], self.protocols[position])
+            remaining = self.counts[key] - 1
+            if remaining:
+                self.counts[key] = remaining
+            else:
+                del self.counts[key]
+            self.removed.add(position)
+            bisect.insort(self.removed_sorted, position)
+            self.deleted += 1
+        self.signature = self._current_signature()
+
+
+class LivePositions:
+    # Secuencia de las posiciones vivas del índice sin materializarla: la
+    # k-ésima se obtiene saltando las borradas con bisect
+    def __init__(self, total, removed, removed_sorted):
+        self.total = total
+        self.removed = removed
+        self.removed_sorted = removed_sorted
+
+    def __len__(self):
+        return self.total - len(self.removed)
+
+    def _physical(self, k):
+        # Menor p con p - (borradas <= p) == k; el menor punto fijo siempre es una posición viva
+        position = k
+        while True:
+            following = k + bisect.bisect_right(self.removed_sorted, position)
+            if following == position:
+                return position
+            position = following
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            if not 0 <= item < len(self):
+                raise IndexError(item)
+            return self._physical(item)
+        start, stop, step = item.indices(len(self))
+        if step != 1:
+            return list(self)[item]
+        positions = []
+        position = self._physical(start) if start < stop else self.total
+        while len(positions) < stop - start and position < self.total:
+            if position not in self.removed:
+                positions.append(position)
+            position += 1
+        return positions
+
+    def __iter__(self):
+        removed = self.removed
+        return (position for position in range(self.total) if position not in removed)
+
+
+def participant_names_by_file(participants):
+    # Los nombres de archivo sustituyen espacios por '_': se resuelven con los participantes conocidos
+    return {ParticipantRepository.display_name(p).replace(' ', '_'): ParticipantRepository.display_name(p)
+            for p in participants}
+
+
+def iter_hr_csv(filename):
+    # Filas (protocolo, tiempo, FC) de un hr_data_*.csv; FC vacía -> None
+    with open(filename, mode='r', newline='', encoding='utf-8') as file:
+        reader = csv.reader(file, delimiter=';')
+        next(reader, None)
+        for row in reader:
+            if len(row) >= 3:
+                yield row[0], float(row[1]), float(row[2]) if row[2] != '' else None
+
+
+def iter_hr_trace(filename):
+    # Igual que iter_hr_csv para una traza binaria
+    trace = read_hr_trace(filename)
+    for protocol, elapsed, hr in zip(trace['protocol'], trace['elapsed'], trace['hr']):
+        hr = float(hr)
+        yield protocol.decode('ascii'), float(elapsed), None if hr != hr else hr
+
+
+def hr_data_filename(data_directory, participant_name):
+    return os.path.join(data_directory, f"hr_data_{participant_name.replace(' ', '_')}.csv")
+
+
+def hr_trace_filename(data_directory, participant_name):
+    return os.path.join(data_directory, f"hr_trace_{participant_name.replace(' ', '_')}.bin")
+
+
+def _starts_new_segment(last_protocol, last_elapsed, protocol, elapsed):
+    # Un ensayo nuevo empieza al cambiar de protocolo o al reiniciarse el tiempo
+    return last_protocol is None or protocol != last_protocol or elapsed < last_elapsed
+
+
+class HRTraceAppender:
+    # Añade filas (protocolo, tiempo, FC) a una traza binaria, abriendo un
+    # segmento nuevo en cada ensayo
+    def __init__(self, filename):
+        self.filename = filename
+        self.segment = -1
+        self.last_protocol = None
+        self.last_elapsed = 0.0
+        if not os.path.exists(filename) or os.path.getsize(filename) < HR_TRACE_HEADER.size:
+            with open(filename, 'wb') as file:
+                file.write(HR_TRACE_HEADER.pack(HR_TRACE_MAGIC, HR_TRACE_VERSION, HR_TRACE_RECORD.size))
+            return
+        with open(filename, 'r+b') as file:
+            magic, _, record_size = HR_TRACE_HEADER.unpack(file.read(HR_TRACE_HEADER.size))
+            if magic != HR_TRACE_MAGIC or record_size != HR_TRACE_RECORD.size:
+                raise ValueError(f"{filename} is not a HR trace file")
+            # Descarta un registro incompleto al final (p. ej. tras un cierre inesperado)
+            size = file.seek(0, os.SEEK_END)
+            records = (size - HR_TRACE_HEADER.size) // HR_TRACE_RECORD.size
+            end = HR_TRACE_HEADER.size + records * HR_TRACE_RECORD.size
+            if end != size:
+                file.truncate(end)
+            if records:
+                # Tras reabrir, el siguiente ensayo continúa en un segmento nuevo
+                file.seek(end - HR_TRACE_RECORD.size)
+                self.segment = HR_TRACE_RECORD.unpack(file.read(HR_TRACE_RECORD.size))[0]
+
+    def append(self, rows):
+        buffer = bytearray(HR_TRACE_RECORD.size * len(rows))
+        for i, (protocol, elapsed, hr) in enumerate(rows):
+            protocol = protocol.encode('ascii', 'replace')
+            elapsed = float(elapsed)
+            if _starts_new_segment(self.last_protocol, self.last_elapsed, protocol, elapsed):
+                self.segment += 1
+            self.last_protocol = protocol
+            self.last_elapsed = elapsed
+            hr = float('nan') if hr is None or hr == '' else float(hr)
+            HR_TRACE_RECORD.pack_into(buffer, i * HR_TRACE_RECORD.size, self.segment, hr, elapsed, protocol)
+        with open(self.filename, 'ab') as file:
+            file.write(buffer)
+
+
+class HRTraceWriter(HRLogWriter):
+    # Igual que HRLogWriter pero escribe en el formato binario
+    def __init__(self, filename, participant=None, **kwargs):
+        self.appender = HRTraceAppender(filename)
+        super().__init__(filename, participant, **kwargs)
+
+    def _write_rows(self, rows):
+        try:
+            self.appender.append(rows)
+        except OSError as error:
+            print("Error escribiendo", self.filename, ":", error)
+            self._count_dropped(len(rows))
+
+
+def read_hr_trace(filename):
+    # Lectura sin copia: devuelve un numpy.memmap estructurado con HR_TRACE_DTYPE
+    with open(filename, 'rb') as file:
+        magic, _, record_size = HR_TRACE_HEADER.unpack(file.read(HR_TRACE_HEADER.size))
+        size = file.seek(0, os.SEEK_END)
+    if magic != HR_TRACE_MAGIC or record_size != HR_TRACE_DTYPE.itemsize:
+        raise ValueError(f"{filename} is not a HR trace file")
+    records = (size - HR_TRACE_HEADER.size) // record_size
+    if not records:
+        return np.empty(0, dtype=HR_TRACE_DTYPE)
+    return np.memmap(filename, dtype=HR_TRACE_DTYPE, mode='r', offset=HR_TRACE_HEADER.size, shape=(records,))
+
+
+def load_hr_traces(data_directory):
+    # {nombre de archivo sin prefijo ni extensión: memmap} para todo el estudio
+    traces = {}
+    for entry in sorted(os.listdir(data_directory)):
+        if entry.startswith("hr_trace_") and entry.endswith(".bin"):
+            traces[entry[len("hr_trace_"):-len(".bin")]] = read_hr_trace(os.path.join(data_directory, entry))
+    return traces
+
+
+def csv_to_hr_trace(csv_filename, trace_filename):
+    # Convierte un hr_data_*.csv al formato binario (sobrescribe el destino)
+    if os.path.exists(trace_filename):
+        os.remove(trace_filename)
+    appender = HRTraceAppender(trace_filename)
+    with open(csv_filename, mode='r', newline='', encoding='utf-8') as file:
+        reader = csv.reader(file, delimiter=';')
+        next(reader, None)
+        batch = []
+        for row in reader:
+            if len(row) < 3:
+                continue
+            batch.append((row[0], float(row[1]), float(row[2]) if row[2] != '' else float('nan')))
+            if len(batch) >= 10000:
+                appender.append(batch)
+                batch = []
+        if batch:
+            appender.append(batch)
+
+
+def hr_trace_to_csv(trace_filename, csv_filename):
+    # Convierte una traza binaria a la disposición CSV original
+    trace = read_hr_trace(trace_filename)
+    with open(csv_filename, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(HR_COLUMNS)
+        for protocol, elapsed, hr in zip(trace['protocol'], trace['elapsed'], trace['hr']):
+            hr = float(hr)
+            writer.writerow([
+                protocol.decode('ascii'),
+                round(float(elapsed), 2),
+                int(hr) if hr.is_integer() else ('' if hr != hr else round(hr, 2))
+            ])
+
+
+class CSVTrialStore:
+    # Resultados en time_data_collection.csv (delimitado por ';'). El id de cada
+    # registro es el desplazamiento en bytes de su fila, estable hasta compactar.
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = TrialIndex(filename)
+        # RLock: la compactación puede ejecutarse en un hilo en segundo plano
+        self.lock = threading.RLock()
+        self._query_cache = None
+        self._column_cache = {}
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def create_if_not_exists(self):
+        if not os.path.exists(self.filename):
+            with open(self.filename, mode='w', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file, delimiter=';')
+                writer.writerow(TRIAL_COLUMNS)
+        else:
+            self.upgrade_header()
+
+    def upgrade_header(self):
+        # Un archivo creado antes de añadir columnas se reescribe una vez con la
+        # cabecera actual; las filas antiguas se quedan con menos campos
+        with self.lock:
+            with open(self.filename, 'rb') as file:
+                header = parse_trial_line(file.readline())
+            if len(header) >= len(TRIAL_COLUMNS):
+                return False
+            self.index.refresh()
+            self._rewrite(TRIAL_COLUMNS)
+            return True
+
+    def contains(self, participant_id, protocol):
+        with self.lock:
+            return self.index.contains(participant_id, protocol)
+
+    def append(self, row):
+        with self.lock:
+            self.index.refresh()
+            offset = os.path.getsize(self.filename)
+            with open(self.filename, 'a', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file, delimiter=';')
+                writer.writerow(row)
+            self.index.add(offset, row[0], row[1])
+
+    def read_rows(self, record_ids):
+        # Lee solo las filas pedidas saltando a su desplazamiento en el archivo
+        rows = []
+        with self.lock, open(self.filename, 'rb') as file:
+            for record_id in record_ids:
+                file.seek(record_id)
+                rows.append((record_id, parse_trial_line(file.readline())))
+        return rows
+
+    def rows(self):
+        # Genera (id de registro, fila) de las filas vivas en orden de archivo.
+        # Se toma una instantánea del índice y del archivo abierto bajo el lock
+        # para que una lectura larga (p. ej. exportar) no bloquee al hilo de Tk.
+        with self.lock:
+            self.index.refresh()
+            offsets = self.index.offsets[:]
+            removed = set(self.index.removed)
+            file = open(self.filename, 'rb')
+        with file:
+            for i, (offset, row) in enumerate(self._read_sequential(file, offsets)):
+                if i not in removed:
+                    yield offset, row
+
+    @staticmethod
+    def _read_sequential(file, offsets):
+        # (desplazamiento, fila) de cada desplazamiento del índice, en orden de archivo
+        position = len(file.readline())
+        i = 0
+        for line in file:
+            if i < len(offsets) and offsets[i] == position:
+                yield position, parse_trial_line(line)
+                i += 1
+            position += len(line)
+
+    def _matching_positions(self, participant=None, protocol=None, sort_column=None, descending=False):
+        # Posiciones en el índice que cumplen el filtro, en el orden pedido. Se
+        # guarda el último resultado para que paginar no repita el filtrado.
+        self.index.refresh()
+        key = (self.index.signature, participant, protocol, sort_column, descending)
+        if self._query_cache and self._query_cache[0] == key:
+            return self._query_cache[1]
+        index = self.index
+        positions = index.live_positions()
+        if participant:
+            needle = participant.lower()
+            names = {name: needle in name.lower() for name in set(index.participants)}
+            positions = [i for i in positions if names[index.participants[i]]]
+        if protocol:
+            positions = [i for i in positions if index.protocols[i] == protocol]
+        if sort_column:
+            values = self._column_values(TRIAL_COLUMNS.index(sort_column))
+            positions = sorted(positions, key=lambda i: _sort_value(values[i]), reverse=descending)
+        self._query_cache = (key, positions)
+        return positions
+
+    def clear_cache(self):
+        # Descarta los resultados de consultas y columnas en memoria (medidas en frío)
+        with self.lock:
+            self._query_cache = None
+            self._column_cache = {}
+
+    def _column_values(self, column):
+        if column == 0:
+            return self.index.participants
+        if column == 1:
+            return self.index.protocols
+        cached = self._column_cache.get(column)
+        if cached and cached[0] == self.index.signature:
+            return cached[1]
+        # Una entrada por posición del índice, incluidas las borradas, para poder
+        # indexar con las posiciones de _matching_positions
+        with open(self.filename, 'rb') as file:
+            values = [row[column] if len(row) > column else ''
+                      for _, row in self._read_sequential(file, self.index.offsets)]
+        self._column_cache[column] = (self.index.signature, values)
+        return values
+
+    def count(self, participant=None, protocol=None):
+        with self.lock:
+            if not participant and not protocol:
+                self.index.refresh()
+                return len(self.index)
+            return len(self._matching_positions(participant, protocol))
+
+    def page(self, offset, limit, participant=None, protocol=None, sort_column=None, descending=False):
+        with self.lock:
+            positions = self._matching_positions(participant, protocol, sort_column, descending)
+            offsets = self.index.offsets
+            return self.read_rows([offsets[i] for i in positions[offset:offset + limit]])
+
+    def delete(self, record_ids):
+        # Borrado por lápidas: se añade una línea por registro al archivo
+        # .deleted en vez de reescribir el CSV
+        with self.lock:
+            self.index.refresh()
+            positions = {}
+            for record_id in record_ids:
+                position = self.index.position_of(record_id)
+                if position is not None:
+                    positions[record_id] = position
+            record_ids = sorted(positions)
+            if not record_ids:
+                return 0
+            entries = []
+            with open(self.filename, 'rb') as file:
+                for record_id in record_ids:
+                    file.seek(record_id)
+                    entries.append(f"{record_id};{_line_checksum(file.readline())}\n")
+            with open(self.index.tombstone_filename, 'a', encoding='utf-8') as file:
+                file.writelines(entries)
+                file.flush()
+                os.fsync(file.fileno())
+            self.index.remove(positions[record_id] for record_id in record_ids)
+            return len(record_ids)
+
+    def pending_deletions(self):
+        with self.lock:
+            self.index.refresh()
+            return self.index.deleted
+
+    def compact(self):
+        # Reescribe el CSV sin las filas borradas (archivo temporal + rename) y
+        # elimina las lápidas. Devuelve el número de filas descartadas.
+        with self.lock:
+            self.index.refresh()
+            if not self.index.deleted and not os.path.exists(self.index.tombstone_filename):
+                return 0
+            removed = self.index.deleted
+            self._rewrite()
+            return removed
+
+    def _rewrite(self, header_columns=None):
+        # Copia solo las filas vivas (y la cabecera nueva si se indica)
+        with self.lock:
+            removed = self.index.removed
+            live = {offset for i, offset in enumerate(self.index.offsets) if i not in removed}
+            directory = os.path.dirname(self.filename) or '.'
+            fd, temp_path = tempfile.mkstemp(prefix='.time_data_', suffix='.tmp', dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as output, open(self.filename, 'rb') as source:
+                    header = source.readline()
+                    if header_columns:
+                        output.write((';'.join(header_columns) + '\r\n').encode('utf-8'))
+                    else:
+                        output.write(header)
+                    position = len(header)
+                    for line in source:
+                        if position in live:
+                            output.write(line)
+                        position += len(line)
+                    output.flush()
+                    os.fsync(output.fileno())
+                os.replace(temp_path, self.filename)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            # Si el proceso muere aquí, las lápidas antiguas ya no coinciden con
+            # ninguna línea y se ignoran
+            if os.path.exists(self.index.tombstone_filename):
+                os.remove(self.index.tombstone_filename)
+            self.index.invalidate()
+
+    def to_dataframe(self):
+        import pandas as pd
+        with self.lock:
+            df = pd.DataFrame([pad_trial_row(row) for _, row in self.rows()], columns=TRIAL_COLUMNS)
+        for column in TRIAL_COLUMNS[2:]:
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+        return df
+
+
+class CSVStorage:
+    # Almacenamiento original: participants.json + CSV de resultados + hr_data_*.csv
+    def __init__(self, data_directory, participants_file, results_file, hr_format=None):
+        self.data_directory = data_directory
+        self.hr_format = hr_format or HR_TRACE_FORMAT
+        self.participants = ParticipantRepository(participants_file)
+        self.trials = CSVTrialStore(results_file)
+
+    def open_hr_log(self, participant_name):
+        if self.hr_format == "binary":
+            return HRTraceWriter(hr_trace_filename(self.data_directory, participant_name), participant_name)
+        filename = hr_data_filename(self.data_directory, participant_name)
+        if not os.path.exists(filename):
+            with open(filename, 'w', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file, delimiter=';')
+                writer.writerow(HR_COLUMNS)
+        return HRLogWriter(filename, participant_name)
+
+    def hr_sources(self, participants):
+        # Genera (n, total, participante, filas) por cada archivo de FC del estudio
+        names = participant_names_by_file(participants)
+        entries = sorted(
+            entry for entry in os.listdir(self.data_directory)
+            if (entry.startswith("hr_data_") and entry.endswith(".csv"))
+            or (entry.startswith("hr_trace_") and entry.endswith(".bin")))
+        for i, entry in enumerate(entries, 1):
+            path = os.path.join(self.data_directory, entry)
+            if entry.endswith(".csv"):
+                stem, samples = entry[len("hr_data_"):-len(".csv")], iter_hr_csv(path)
+            else:
+                stem, samples = entry[len("hr_trace_"):-len(".bin")], iter_hr_trace(path)
+            yield i, len(entries), names.get(stem, stem.replace('_', ' ')), samples
+
+    def close(self):
+        pass
+
+
+# ---------------------------------------------------------------------------
+#                       BACKEND SQLITE (OPCIONAL)
+# ---------------------------------------------------------------------------
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS participants (
+    id INTEGER PRIMARY KEY,
+    type TEXT,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    birth_date TEXT NOT NULL,
+    sex TEXT,
+    hrrest REAL,
+    display_name TEXT NOT NULL,
+    resting_rmssd_ms REAL,
+    resting_sdnn_ms REAL,
+    resting_pnn50 REAL,
+    resting_rr_mean_hr REAL,
+    resting_rr_artifacts REAL,
+    resting_duration_s REAL,
+    resting_rejected_samples REAL,
+    resting_criterion TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_participants_key ON participants (first_name, last_name, birth_date);
+CREATE INDEX IF NOT EXISTS idx_participants_name ON participants (display_name);
+CREATE TABLE IF NOT EXISTS trials (
+    id INTEGER PRIMARY KEY,
+    participant TEXT NOT NULL,
+    protocol TEXT NOT NULL,
+    time_seconds REAL,
+    rpe INTEGER,
+    mean_hr REAL,
+    stop_latency_ms REAL,
+    cue_latency_ms REAL,
+    skipped_hr_samples REAL,
+    min_hr REAL,
+    max_hr REAL,
+    hr_sd REAL,
+    time_below_zone REAL,
+    time_in_zone REAL,
+    time_above_zone REAL,
+    rmssd_ms REAL,
+    sdnn_ms REAL,
+    pnn50 REAL,
+    rr_mean_hr REAL,
+    rr_artifacts REAL
+);
+CREATE INDEX IF NOT EXISTS idx_trials_key ON trials (participant, protocol);
+CREATE TABLE IF NOT EXISTS hr_samples (
+    participant TEXT NOT NULL,
+    protocol TEXT NOT NULL,
+    elapsed REAL NOT NULL,
+    hr REAL
+);
+CREATE INDEX IF NOT EXISTS idx_hr_samples_key ON hr_samples (participant, protocol, elapsed);
+"""
+
+# Correspondencia entre las claves de participants.json y las columnas SQL
+PARTICIPANT_FIELDS = (
+    ("Type", "type"),
+    ("First Name", "first_name"),
+    ("Last Name", "last_name"),
+    ("Birth Date", "birth_date"),
+    ("Sex", "sex"),
+    ("HRrest", "hrrest"),
+    ("Resting RMSSD (ms)", "resting_rmssd_ms"),
+    ("Resting SDNN (ms)", "resting_sdnn_ms"),
+    ("Resting pNN50 (%)", "resting_pnn50"),
+    ("Resting RR Mean HR", "resting_rr_mean_hr"),
+    ("Resting RR Artifacts", "resting_rr_artifacts"),
+    ("Resting Duration (s)", "resting_duration_s"),
+    ("Resting Rejected Samples", "resting_rejected_samples"),
+    ("Resting Criterion", "resting_criterion"),
+)
+_PARTICIPANT_TYPES = {"resting_criterion": "TEXT"}
+# Campos que solo existen tras medir en reposo: si son NULL no se devuelven
+_PARTICIPANT_OPTIONAL = {field for field, _ in PARTICIPANT_FIELDS[5:]}
+_PARTICIPANT_COLUMN = dict(PARTICIPANT_FIELDS)
+_PARTICIPANT_SELECT = "SELECT " + ", ".join(column for _, column in PARTICIPANT_FIELDS) + " FROM participants"
+
+
+TRIAL_SQL_SELECT = ", ".join(TRIAL_SQL_COLUMNS)
+TRIAL_SQL_INSERT = (f"INSERT INTO trials ({TRIAL_SQL_SELECT}) "
+                    f"VALUES ({', '.join('?' for _ in TRIAL_SQL_COLUMNS)})")
+
+
+def migrate_columns(conn, table, columns, types=None):
+    # Añade a una base de datos antigua las columnas que le falten (REAL salvo que types diga otra cosa)
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    types = types or {}
+    with conn:
+        for column in columns:
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {types.get(column, 'REAL')}")
+
+
+def connect_sqlite(path):
+    conn = sqlite3.connect(path, timeout=10.0)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SQLiteParticipantRepository:
+    # Misma interfaz que ParticipantRepository, respaldada por la tabla participants
+    def __init__(self, conn):
+        self.conn = conn
+
+    @staticmethod
+    def _to_dict(row):
+        participant = {}
+        for (field, _), value in zip(PARTICIPANT_FIELDS, row):
+            if value is not None or field not in _PARTICIPANT_OPTIONAL:
+                participant[field] = value
+        return participant
+
+    def exists(self):
+        return True
+
+    def refresh(self):
+        pass
+
+    def all(self):
+        return [self._to_dict(row) for row in self.conn.execute(_PARTICIPANT_SELECT + " ORDER BY id")]
+
+    def find(self, first_name, last_name, birth_date):
+        row = self.conn.execute(
+            _PARTICIPANT_SELECT + " WHERE first_name = ? AND last_name = ? AND birth_date = ? ORDER BY id LIMIT 1",
+            (first_name, last_name, birth_date)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def find_by_name(self, name):
+        row = self.conn.execute(_PARTICIPANT_SELECT + " WHERE display_name = ? ORDER BY id LIMIT 1",
+                                (name,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def is_duplicate(self, participant_info):
+        row = self.conn.execute(
+            "SELECT 1 FROM participants WHERE first_name = ? AND last_name = ? AND birth_date = ? AND sex = ? LIMIT 1",
+            (participant_info["First Name"], participant_info["Last Name"],
+             participant_info["Birth Date"], participant_info["Sex"])).fetchone()
+        return row is not None
+
+    def add(self, participant_info):
+        with self.conn:
+            self._insert(self.conn, participant_info)
+
+    @staticmethod
+    def _insert(conn, participant_info):
+        values = [participant_info.get(field) for field, _ in PARTICIPANT_FIELDS]
+        values.append(ParticipantRepository.display_name(participant_info))
+        columns = [column for _, column in PARTICIPANT_FIELDS] + ["display_name"]
+        conn.execute(
+            f"INSERT INTO participants ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})", values)
+
+    def update(self, participant_record, **fields):
+        assignments = ", ".join(f"{_PARTICIPANT_COLUMN[field]} = ?" for field in fields)
+        with self.conn:
+            cursor = self.conn.execute(
+                f"UPDATE participants SET {assignments} WHERE id = ("
+                "SELECT id FROM participants WHERE first_name = ? AND last_name = ? AND birth_date = ? "
+                "ORDER BY id LIMIT 1)",
+                list(fields.values()) + list(ParticipantRepository.key_of(participant_record)))
+        if not cursor.rowcount:
+            return None
+        return self.find(*ParticipantRepository.key_of(participant_record))
+
+    def remove(self, participant_record):
+        with self.conn:
+            cursor = self.conn.execute(
+                "DELETE FROM participants WHERE id = ("
+                "SELECT id FROM participants WHERE first_name = ? AND last_name = ? AND birth_date = ? "
+                "ORDER BY id LIMIT 1)",
+                ParticipantRepository.key_of(participant_record))
+        return cursor.rowcount > 0
+
+
+class SQLiteTrialStore:
+    # Misma interfaz que CSVTrialStore, respaldada por la tabla trials
+    def __init__(self, conn, path):
+        self.conn = conn
+        self.path = path
+        self._owner = threading.get_ident()
+
+    def exists(self):
+        return True
+
+    def create_if_not_exists(self):
+        pass
+
+    def clear_cache(self):
+        # SQLite no guarda consultas en memoria de la aplicación
+        pass
+
+    def contains(self, participant_id, protocol):
+        row = self.conn.execute("SELECT 1 FROM trials WHERE participant = ? AND protocol = ? LIMIT 1",
+                                (participant_id, protocol)).fetchone()
+        return row is not None
+
+    def append(self, row):
+        with self.conn:
+            self.conn.execute(TRIAL_SQL_INSERT, [value if value != '' else None for value in pad_trial_row(row)])
+
+    def rows(self):
+        # Desde otro hilo (p. ej. la exportación) se usa una conexión propia
+        conn = self.conn if threading.get_ident() == self._owner else connect_sqlite(self.path)
+        try:
+            cursor = conn.execute(f"SELECT id, {TRIAL_SQL_SELECT} FROM trials ORDER BY id")
+            for record in cursor:
+                yield record[0], ['' if value is None else value for value in record[1:]]
+        finally:
+            if conn is not self.conn:
+                conn.close()
+
+    @staticmethod
+    def _where(participant, protocol):
+        clauses = []
+        params = []
+        if participant:
+            escaped = participant.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            clauses.append("participant LIKE ? ESCAPE '\\'")
+            params.append(f"%{escaped}%")
+        if protocol:
+            clauses.append("protocol = ?")
+            params.append(protocol)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def count(self, participant=None, protocol=None):
+        where, params = self._where(participant, protocol)
+        return self.conn.execute("SELECT COUNT(*) FROM trials" + where, params).fetchone()[0]
+
+    def page(self, offset, limit, participant=None, protocol=None, sort_column=None, descending=False):
+        where, params = self._where(participant, protocol)
+        order = "id"
+        if sort_column:
+            direction = "DESC" if descending else "ASC"
+            order = f"{TRIAL_SQL_COLUMNS[TRIAL_COLUMNS.index(sort_column)]} {direction}, id"
+        cursor = self.conn.execute(
+            f"SELECT id, {TRIAL_SQL_SELECT} FROM trials{where} ORDER BY {order} LIMIT ? OFFSET ?",
+            params + [limit, offset])
+        return [(record[0], ['' if value is None else value for value in record[1:]]) for record in cursor]
+
+    def delete(self, record_ids):
+        with self.conn:
+            cursor = self.conn.executemany("DELETE FROM trials WHERE id = ?", ((i,) for i in record_ids))
+        return cursor.rowcount
+
+    def pending_deletions(self):
+        # Los borrados en SQLite son inmediatos: nunca hay nada que compactar
+        return 0
+
+    def compact(self):
+        return 0
+
+    def to_dataframe(self):
+        import pandas as pd
+        columns = ", ".join(f'{column} AS "{name}"' for column, name in zip(TRIAL_SQL_COLUMNS, TRIAL_COLUMNS))
+        return pd.read_sql_query(f"SELECT {columns} FROM trials ORDER BY id", self.conn)
+
+
+class SQLiteHRLogWriter(HRLogWriter):
+    # Inserta las filas de FC en hr_samples. La conexión se abre dentro del hilo
+    # del escritor porque sqlite3 no comparte conexiones entre hilos.
+    def __init__(self, db_path, participant, **kwargs):
+        self._conn = None
+        super().__init__(db_path, participant, **kwargs)
+
+    def _write_rows(self, rows):
+        try:
+            if self._conn is None:
+                self._conn = connect_sqlite(self.filename)
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO hr_samples (participant, protocol, elapsed, hr) VALUES (?, ?, ?, ?)",
+                    ((self.participant,) + tuple(row) for row in rows))
+        except sqlite3.Error as error:
+            print("Error escribiendo", self.filename, ":", error)
+            self._count_dropped(len(rows))
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class SQLiteStorage:
+    def __init__(self, path):
+        self.path = path
+        self.conn = connect_sqlite(path)
+        self.conn.executescript(SQLITE_SCHEMA)
+        migrate_columns(self.conn, "trials", TRIAL_SQL_COLUMNS)
+        migrate_columns(self.conn, "participants", [column for _, column in PARTICIPANT_FIELDS], _PARTICIPANT_TYPES)
+        self.participants = SQLiteParticipantRepository(self.conn)
+        self.trials = SQLiteTrialStore(self.conn, path)
+
+    def is_empty(self):
+        for table in ("participants", "trials", "hr_samples"):
+            if self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                return False
+        return True
+
+    def open_hr_log(self, participant_name):
+        return SQLiteHRLogWriter(self.path, participant_name)
+
+    def hr_sources(self, participants):
+        # Pensado para ejecutarse fuera del hilo de Tk: abre su propia conexión.
+        # Las filas salen en el orden en que se grabaron (rowid), como en los
+        # hr_data_*.csv, para que cada ensayo (incluidos los cancelados y sus
+        # repeticiones) siga siendo un tramo separado
+        conn = connect_sqlite(self.path)
+        try:
+            names = [row[0] for row in conn.execute("SELECT DISTINCT participant FROM hr_samples ORDER BY participant")]
+            for i, name in enumerate(names, 1):
+                samples = conn.execute(
+                    "SELECT protocol, elapsed, hr FROM hr_samples WHERE participant = ? ORDER BY rowid",
+                    (name,))
+                yield i, len(names), name, samples
+        finally:
+            conn.close()
+
+    def import_legacy_files(self, participants_file, results_file, data_directory):
+        # Importación única de participants.json, el CSV de resultados y todos los
+        # hr_data_*.csv y hr_trace_*.bin, en una sola transacción y leyendo los CSV en streaming.
+        counts = {"participants": 0, "trials": 0, "hr_samples": 0}
+        participants = []
+        if os.path.exists(participants_file):
+            with open(participants_file, 'r') as file:
+                participants = json.load(file)
+        names_by_file = participant_names_by_file(participants)
+        with self.conn:
+            for participant in participants:
+                SQLiteParticipantRepository._insert(self.conn, participant)
+            counts["participants"] = len(participants)
+            if os.path.exists(results_file):
+                with open(results_file, mode='r', newline='', encoding='utf-8') as file:
+                    reader = csv.reader(file, delimiter=';')
+                    next(reader, None)
+                    cursor = self.conn.executemany(
+                        TRIAL_SQL_INSERT,
+                        ([value if value != '' else None for value in pad_trial_row(row)]
+                         for row in reader if len(row) >= len(TRIAL_TABLE_COLUMNS)))
+                    counts["trials"] = cursor.rowcount
+            for entry in sorted(os.listdir(data_directory)):
+                if entry.startswith("hr_data_") and entry.endswith(".csv"):
+                    stem, reader = entry[len("hr_data_"):-len(".csv")], iter_hr_csv
+                elif entry.startswith("hr_trace_") and entry.endswith(".bin"):
+                    stem, reader = entry[len("hr_trace_"):-len(".bin")], iter_hr_trace
+                else:
+                    continue
+                participant_name = names_by_file.get(stem, stem.replace('_', ' '))
+                # Las celdas de FC vacías (huecos de señal) se guardan como NULL
+                cursor = self.conn.executemany(
+                    "INSERT INTO hr_samples (participant, protocol, elapsed, hr) VALUES (?, ?, ?, ?)",
+                    ((participant_name, protocol, elapsed, hr)
+                     for protocol, elapsed, hr in reader(os.path.join(data_directory, entry))))
+                counts["hr_samples"] += cursor.rowcount
+        return counts
+
+    def close(self):
+        self.conn.close()
+
+
+def open_storage(data_directory, participants_file, results_file, backend=None):
+    backend = backend or STORAGE_BACKEND
+    if backend == "sqlite":
+        storage = SQLiteStorage(os.path.join(data_directory, SQLITE_FILENAME))
+        # La primera vez se importan los archivos existentes
+        if storage.is_empty():
+            counts = storage.import_legacy_files(participants_file, results_file, data_directory)
+            print("Importado a SQLite:", counts)
+        return storage
+    return CSVStorage(data_directory, participants_file, results_file)
+
+
+# ---------------------------------------------------------------------------
+#                        EXPORTACIÓN A EXCEL
+# ---------------------------------------------------------------------------
+EXCEL_MAX_ROWS = 1048576
+HR_TRACE_SHEET_COLUMNS = ['Participant', 'Protocol', 'Trial', 'Elapsed Time (s)', 'HR (bpm)']
+
 
-    def notification_handler(self, sender: int, data: bytearray):
-        if len(data) > 1:
-            # Se asume que el segundo byte contiene la FC (8 bits)
-            self.current_hr = data[1]
+class ExportCancelled(Exception):
+    pass
 
-    async def run(self):
-        async with BleakClient(self.address) as client:
-            print("Conectado a:", self.address)
-            await client.start_notify(HR_MEASUREMENT_CHAR_UUID, self.notification_handler)
-            while self.running:
-                await asyncio.sleep(1)
-            await client.stop_notify(HR_MEASUREMENT_CHAR_UUID)
-        print("Desconectado de:", self.address)
+
+def _excel_value(value):
+    # Los CSV devuelven texto: se pasan a número cuando se puede
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+        return int(number) if number.is_integer() and '.' not in value else number
+    return value
+
+
+def _excel_sheet_title(title):
+    for char in '[]:*?/\\':
+        title = title.replace(char, '_')
+    return title[:31] or 'Sheet'
+
+
+class _SheetWriter:
+    # Hoja en modo write-only que continúa en "<título> 2", "<título> 3"...
+    # al llegar al límite de filas de Excel
+    def __init__(self, workbook, title, header):
+        self.workbook = workbook
+        self.title = title
+        self.header = header
+        self.part = 0
+        self.sheet = None
+        self.rows = EXCEL_MAX_ROWS
+
+    def new_sheet(self):
+        self.part += 1
+        suffix = f" {self.part}" if self.part > 1 else ""
+        self.sheet = self.workbook.create_sheet(_excel_sheet_title(self.title[:31 - len(suffix)] + suffix))
+        self.sheet.append(self.header)
+        self.rows = 1
+
+    def append(self, values):
+        if self.rows >= EXCEL_MAX_ROWS:
+            self.new_sheet()
+        self.sheet.append(values)
+        self.rows += 1
+
+
+class ExcelExporter:
+    # Exporta en un hilo aparte con openpyxl en modo write-only: las filas se
+    # escriben según se leen y la memoria no crece con el tamaño del estudio.
+    # El progreso se comunica por una cola que la ventana consulta con after().
+    def __init__(self, storage, filename, per_protocol=False, include_hr=False):
+        self.storage = storage
+        self.filename = filename
+        self.per_protocol = per_protocol
+        self.include_hr = include_hr
+        # Datos que solo se pueden leer desde el hilo de Tk
+        self.total = storage.trials.count()
+        self.participants = list(storage.participants.all())
+        self.messages = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
 
     def start(self):
-        self.running = True
-        self.loop = asyncio.new_event_loop()
-        self.thread = threading.Thread(target=self._run_loop)
         self.thread.start()
 
-    def _run_loop(self):
-        asyncio.set_event_loop(self.loop)
-        self.loop.run_until_complete(self.run())
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_running(self):
+        return self.thread.is_alive()
+
+    def _check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise ExportCancelled()
+
+    def _run(self):
+        with METRICS.time("file_op_seconds", op="export"):
+            self._export()
+
+    def _export(self):
+        directory = os.path.dirname(self.filename) or '.'
+        fd, temp_path = tempfile.mkstemp(prefix='.export_', suffix='.xlsx', dir=directory)
+        os.close(fd)
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        try:
+            self._write_trials(workbook)
+            if self.include_hr:
+                self._write_hr_traces(workbook)
+            self._check_cancelled()
+            self.messages.put(('progress', 1, 1, "Saving workbook..."))
+            workbook.save(temp_path)
+            os.replace(temp_path, self.filename)
+            self.messages.put(('done', self.filename))
+        except ExportCancelled:
+            self._discard(workbook)
+            self.messages.put(('cancelled',))
+        except Exception as error:
+            self._discard(workbook)
+            self.messages.put(('error', str(error)))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @staticmethod
+    def _discard(workbook):
+        # Cierra las hojas a medio escribir para liberar sus archivos temporales
+        for sheet in workbook.worksheets:
+            if not sheet.closed:
+                sheet.close()
+
+    def _write_trials(self, workbook):
+        results = _SheetWriter(workbook, "Results", TRIAL_COLUMNS)
+        protocol_sheets = {}
+        for i, (_, row) in enumerate(self.storage.trials.rows(), 1):
+            values = [_excel_value(value) for value in row[:len(TRIAL_COLUMNS)]]
+            results.append(values)
+            if self.per_protocol:
+                protocol = str(row[1])
+                if protocol not in protocol_sheets:
+                    protocol_sheets[protocol] = _SheetWriter(workbook, protocol, TRIAL_COLUMNS)
+                protocol_sheets[protocol].append(values)
+            if i % 1000 == 0:
+                self._check_cancelled()
+                self.messages.put(('progress', i, self.total, f"Exporting trials: {i}/{self.total}"))
+        if results.sheet is None:
+            results.new_sheet()
+
+    def _write_hr_traces(self, workbook):
+        traces = _SheetWriter(workbook, "HR Traces", HR_TRACE_SHEET_COLUMNS)
+        for number, total, participant, samples in self.storage.hr_sources(self.participants):
+            self._check_cancelled()
+            self.messages.put(('progress', number - 1, total, f"Exporting HR traces: {participant} ({number}/{total})"))
+            trial = 0
+            last_protocol = None
+            last_elapsed = 0.0
+            for i, (protocol, elapsed, hr) in enumerate(samples):
+                if _starts_new_segment(last_protocol, last_elapsed, protocol, elapsed):
+                    trial += 1
+                last_protocol = protocol
+                last_elapsed = elapsed
+                traces.append([participant, protocol, trial, elapsed, hr])
+                if i % 5000 == 0:
+                    self._check_cancelled()
+
+
+# ---------------------------------------------------------------------------
+#                  ANÁLISIS POR LOTES (SIN INTERFAZ)
+# ---------------------------------------------------------------------------
+# Uso: python index.py analyze [--data-dir data] [--output analysis.csv]
+#                              [--target-seconds 60] [--workers 4]
+HR_ZONE_LOW = 0.70
+HR_ZONE_HIGH = 0.90
+# Diferencia máxima entre la duración de un tramo de FC y el tiempo del ensayo
+TRIAL_MATCH_TOLERANCE = 2.0
+ANALYSIS_COLUMNS = ['participant', 'protocol', 'trial', 'time_seconds', 'rpe', 'mean_hr_recorded',
+                    'hr_samples', 'hr_valid_samples', 'hr_duration_s', 'hr_mean', 'hr_peak',
+                    'hr_rest', 'age', 'zone_low', 'zone_high', 'time_in_zone_s', 'time_in_zone_pct',
+                    'target_seconds', 'estimation_error_s', 'estimation_error_pct']
+
+
+def participant_age(birth_date, today=None):
+    import datetime
+    birth_date = datetime.datetime.strptime(birth_date, '%d/%m/%Y').date()
+    today = today or datetime.date.today()
+    return today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
+
+
+def hr_target_zone(hr_rest, age):
+    # Zona objetivo del 70-90 % de la FC de reserva (Karvonen, FCmáx = 220 - edad)
+    hrr = (220 - age) - hr_rest
+    return hr_rest + hrr * HR_ZONE_LOW, hr_rest + hrr * HR_ZONE_HIGH
+
+
+def read_hr_frame(filename):
+    # Traza de FC como DataFrame (protocol, elapsed, hr) con una columna segment por ensayo
+    import pandas as pd
+    if filename.endswith('.bin'):
+        trace = read_hr_trace(filename)
+        return pd.DataFrame({
+            'protocol': np.char.decode(np.asarray(trace['protocol']), 'ascii'),
+            'elapsed': np.asarray(trace['elapsed'], dtype=float),
+            'hr': np.asarray(trace['hr'], dtype=float),
+            'segment': np.asarray(trace['segment'], dtype=np.int64),
+        })
+    frame = pd.read_csv(filename, sep=';', header=0, names=['protocol', 'elapsed', 'hr'],
+                        dtype={'protocol': str}, usecols=[0, 1, 2])
+    frame['elapsed'] = pd.to_numeric(frame['elapsed'], errors='coerce')
+    frame['hr'] = pd.to_numeric(frame['hr'], errors='coerce')
+    # Igual que _starts_new_segment: cambia el protocolo o se reinicia el tiempo
+    new_segment = (frame['protocol'] != frame['protocol'].shift()) | (frame['elapsed'] < frame['elapsed'].shift())
+    frame['segment'] = new_segment.cumsum()
+    return frame
+
+
+def summarize_hr_segments(frame, zone=None):
+    # Una fila por tramo (ensayo). Cada muestra pesa el intervalo hasta la
+    # siguiente; la última de cada tramo, la mediana de los intervalos del tramo.
+    if frame.empty:
+        return frame.iloc[0:0]
+    groups = frame.groupby('segment', sort=False)
+    step = groups['elapsed'].shift(-1) - frame['elapsed']
+    step = step.fillna(groups['elapsed'].transform(lambda values: values.diff().median())).fillna(1.0)
+    valid = frame['hr'].notna()
+    frame = frame.assign(step=step, valid=valid, valid_time=step.where(valid, 0.0))
+    if zone:
+        in_zone = frame['hr'].between(zone[0], zone[1])
+        frame['zone_time'] = step.where(in_zone, 0.0)
+    else:
+        frame['zone_time'] = np.nan
+    summary = frame.groupby('segment', sort=False).agg(
+        protocol=('protocol', 'first'),
+        hr_samples=('hr', 'size'),
+        hr_valid_samples=('valid', 'sum'),
+        hr_duration_s=('elapsed', 'max'),
+        hr_mean=('hr', 'mean'),
+        hr_peak=('hr', 'max'),
+        valid_time=('valid_time', 'sum'),
+        time_in_zone_s=('zone_time', 'sum'),
+    )
+    if not zone:
+        summary['time_in_zone_s'] = np.nan
+    summary['time_in_zone_pct'] = 100.0 * summary['time_in_zone_s'] / summary['valid_time'].where(summary['valid_time'] > 0)
+    return summary.drop(columns='valid_time').reset_index(drop=True)
+
+
+def analyze_participant(task):
+    # Trabajo de un proceso del pool: todos los ensayos de un participante.
+    # Cada ensayo se empareja con el siguiente tramo de FC de su protocolo
+    # cuya duración coincide con el tiempo medido; los tramos sin ensayo
+    # (pruebas canceladas o registros borrados) se saltan.
+    participant, hr_filename, trials, hr_rest, age, target_seconds = task
+    zone = hr_target_zone(hr_rest, age) if hr_rest is not None and age is not None else None
+    segments = {}
+    if hr_filename:
+        try:
+            summary = summarize_hr_segments(read_hr_frame(hr_filename), zone)
+        except Exception as error:
+            print("Error al leer", hr_filename, ":", error)
+        else:
+            for record in summary.to_dict('records'):
+                segments.setdefault(record['protocol'], []).append(record)
+    positions = {}
+    trial_numbers = {}
+    rows = []
+    for protocol, time_seconds, rpe, mean_hr in trials:
+        trial_numbers[protocol] = trial_numbers.get(protocol, 0) + 1
+        row = dict.fromkeys(ANALYSIS_COLUMNS)
+        row.update(participant=participant, protocol=protocol, trial=trial_numbers[protocol],
+                   time_seconds=time_seconds, rpe=rpe, mean_hr_recorded=mean_hr, hr_rest=hr_rest, age=age,
+                   target_seconds=target_seconds)
+        if zone:
+            row['zone_low'], row['zone_high'] = zone
+        candidates = segments.get(protocol, [])
+        position = positions.get(protocol, 0)
+        while position < len(candidates):
+            segment = candidates[position]
+            position += 1
+            if time_seconds == time_seconds and abs(time_seconds - segment['hr_duration_s']) <= TRIAL_MATCH_TOLERANCE:
+                row.update((key, value) for key, value in segment.items() if key in row and key != 'protocol')
+                break
+        positions[protocol] = position
+        if target_seconds:
+            row['estimation_error_s'] = time_seconds - target_seconds
+            row['estimation_error_pct'] = 100.0 * (time_seconds - target_seconds) / target_seconds
+        rows.append(row)
+    return rows
+
+
+def _float_or_nan(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def analysis_tasks(data_directory, participants_file, results_file, target_seconds=None):
+    # Agrupa los ensayos por participante y localiza su archivo de FC
+    participants = ParticipantRepository(participants_file).all()
+    by_name = {ParticipantRepository.display_name(p): p for p in participants}
+    names_by_file = participant_names_by_file(participants)
+    hr_files = {}
+    for entry in sorted(os.listdir(data_directory)):
+        for prefix, suffix in (("hr_data_", ".csv"), ("hr_trace_", ".bin")):
+            if entry.startswith(prefix) and entry.endswith(suffix):
+                stem = entry[len(prefix):-len(suffix)]
+                name = names_by_file.get(stem, stem.replace('_', ' '))
+                # Si hay traza binaria y CSV del mismo participante se usa la binaria
+                if suffix == ".bin" or name not in hr_files:
+                    hr_files[name] = os.path.join(data_directory, entry)
+    trials = {}
+    if os.path.exists(results_file):
+        for _, row in CSVTrialStore(results_file).rows():
+            row = pad_trial_row(row)
+            trials.setdefault(row[0], []).append(
+                (row[1], _float_or_nan(row[2]), _float_or_nan(row[3]), _float_or_nan(row[4])))
+    tasks = []
+    for participant, participant_trials in trials.items():
+        record = by_name.get(participant) or {}
+        hr_rest = record.get("HRrest")
+        try:
+            age = participant_age(record["Birth Date"])
+        except (KeyError, TypeError, ValueError):
+            age = None
+        tasks.append((participant, hr_files.get(participant), participant_trials,
+                      hr_rest if hr_rest not in (None, '', 0) else None, age, target_seconds))
+    return tasks
+
+
+def analyze_study(data_directory, participants_file, results_file, target_seconds=None, workers=None):
+    # Tabla ordenada (una fila por ensayo) procesando a cada participante en un proceso aparte
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor
+    tasks = analysis_tasks(data_directory, participants_file, results_file, target_seconds)
+    rows = []
+    if workers == 1 or len(tasks) < 2:
+        for task in tasks:
+            rows.extend(analyze_participant(task))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for participant_rows in pool.map(analyze_participant, tasks, chunksize=max(1, len(tasks) // 64)):
+                rows.extend(participant_rows)
+    return pd.DataFrame(rows, columns=ANALYSIS_COLUMNS)
+
+
+def analyze_main(argv):
+    import argparse
+    default_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    parser = argparse.ArgumentParser(prog="index.py analyze",
+                                     description="Per-trial HR and time estimation summaries, without the GUI.")
+    parser.add_argument('--data-dir', default=default_data)
+    parser.add_argument('--output', default=None, help="output CSV (default: <data-dir>/analysis.csv)")
+    parser.add_argument('--target-seconds', type=float, default=None,
+                        help="target interval used to compute the estimation error")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes (default: all CPUs)")
+    args = parser.parse_args(argv)
+    started = time.perf_counter()
+    table = analyze_study(args.data_dir, os.path.join(args.data_dir, 'participants.json'),
+                          os.path.join(args.data_dir, 'time_data_collection.csv'),
+                          args.target_seconds, args.workers)
+    output = args.output or os.path.join(args.data_dir, 'analysis.csv')
+    table.to_csv(output, sep=';', index=False)
+    print(f"{len(table)} trials analysed in {time.perf_counter() - started:.2f} s -> {output}")
+    return 0
+
+
+# ---------------------------------------------------------------------------
+#                       SEÑAL SONORA DE INICIO
+# ---------------------------------------------------------------------------
+# Búfer pequeño del mezclador: el retardo hasta que suena es de un búfer
+MIXER_FREQUENCY = 44100
+MIXER_BUFFER = 256
+CUE_ONSET_THRESHOLD = 0.02
+
+
+def sound_leading_silence(sound, threshold=CUE_ONSET_THRESHOLD):
+    # Segundos de silencio al principio del sonido (hasta la primera muestra
+    # que supera threshold respecto al fondo de escala)
+    import pygame
+    frequency, size, _ = pygame.mixer.get_init()
+    samples = pygame.sndarray.array(sound)
+    if not samples.size:
+        return 0.0
+    full_scale = float(1 << (abs(size) - 1))
+    loud = np.flatnonzero(np.abs(samples.reshape(len(samples), -1)).max(axis=1) > threshold * full_scale)
+    return float(loud[0]) / frequency if loud.size else 0.0
+
+
+class StartCue:
+    # start.wav decodificado una sola vez como Sound. play() devuelve el
+    # instante estimado en que empieza a oírse: llamada a play() + un búfer del
+    # mezclador + el silencio inicial del archivo
+    def __init__(self, filename):
+        import pygame
+        if not pygame.mixer.get_init():
+            pygame.mixer.init(frequency=MIXER_FREQUENCY, size=-16, channels=2, buffer=MIXER_BUFFER)
+        self.sound = pygame.mixer.Sound(filename)
+        frequency = pygame.mixer.get_init()[0]
+        self.output_latency = MIXER_BUFFER / frequency
+        self.leading_silence = sound_leading_silence(self.sound)
+
+    def play(self):
+        # Devuelve (instante de inicio audible, latencia desde la llamada en segundos)
+        called = time.perf_counter()
+        self.sound.play()
+        onset = time.perf_counter() + self.output_latency + self.leading_silence
+        return onset, onset - called
+
+
+# ---------------------------------------------------------------------------
+#                 ARRANQUE: ANIMACIÓN Y TIEMPOS DE CARGA
+# ---------------------------------------------------------------------------
+class LazyGifFrames:
+    # Los fotogramas del GIF se decodifican en un hilo aparte (PIL) y cada uno
+    # se convierte en PhotoImage en el hilo de Tk la primera vez que se muestra
+    def __init__(self, filename, on_loaded=None):
+        self.filename = filename
+        self.images = []
+        self.photos = {}
+        self.done = False
+        self.error = None
+        self.on_loaded = on_loaded
+        self.thread = threading.Thread(target=self._decode, daemon=True)
+        self.thread.start()
+
+    def _decode(self):
+        started = time.perf_counter()
+        try:
+            from PIL import Image, ImageSequence
+            with Image.open(self.filename) as gif:
+                for frame in ImageSequence.Iterator(gif):
+                    self.images.append(frame.copy().convert('RGBA'))
+        except Exception as error:
+            self.error = error
+            print("Error al cargar", self.filename, ":", error)
+        self.done = True
+        if self.on_loaded:
+            self.on_loaded(time.perf_counter() - started)
+
+    def __len__(self):
+        # Solo los fotogramas ya decodificados
+        return len(self.images)
+
+    def __getitem__(self, index):
+        photo = self.photos.get(index)
+        if photo is None:
+            from PIL import ImageTk
+            photo = self.photos[index] = ImageTk.PhotoImage(self.images[index])
+        return photo
+
+
+class StartupTimer:
+    # Duración de cada fase del arranque, medida desde el inicio del módulo
+    def __init__(self, start=STARTUP_T0):
+        self.start = start
+        self.last = start
+        self.phases = []
+        self.lock = threading.Lock()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        with self.lock:
+            self.phases.append((phase, now - self.last))
+            self.last = now
+
+    def add(self, phase, seconds):
+        # Fases en segundo plano, que no suman al tiempo hasta la ventana
+        with self.lock:
+            self.phases.append((phase + " (background)", seconds))
+
+    def report(self):
+        with self.lock:
+            lines = [f"  {phase:<32s}{seconds * 1000:9.1f} ms" for phase, seconds in self.phases]
+            total = self.last - self.start
+        print("Tiempos de arranque:\n" + "\n".join(lines) + f"\n  {'total':<32s}{total * 1000:9.1f} ms")
+
+
+# ---------------------------------------------------------------------------
+#                  ESTADÍSTICAS DE FC DURANTE EL ENSAYO
+# ---------------------------------------------------------------------------
+class HRTrialStats:
+    # Estadísticos acumulados con O(1) por muestra (media y varianza con el
+    # algoritmo de Welford, mínimo, máximo y segundos por debajo, dentro y por
+    # encima de la zona objetivo), sin guardar las muestras: la traza completa
+    # ya está en el registro de FC y en la gráfica. Cada muestra cuenta el tiempo transcurrido desde la anterior; tras un
+    # hueco sin señal ese tiempo no se asigna a ninguna zona.
+    def __init__(self, zone=None):
+        self.zone = zone
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = None
+        self.max = None
+        self.below = 0.0
+        self.inside = 0.0
+        self.above = 0.0
+        self._last_elapsed = None
+
+    def add(self, elapsed, hr):
+        if hr is None:
+            self._last_elapsed = None
+            return
+        self.count += 1
+        delta = hr - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (hr - self.mean)
+        self.min = hr if self.min is None else min(self.min, hr)
+        self.max = hr if self.max is None else max(self.max, hr)
+        if self.zone and self._last_elapsed is not None:
+            step = elapsed - self._last_elapsed
+            if hr < self.zone[0]:
+                self.below += step
+            elif hr > self.zone[1]:
+                self.above += step
+            else:
+                self.inside += step
+        self._last_elapsed = elapsed
+
+    @property
+    def sd(self):
+        return (self._m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.0
+
+    def in_zone_percent(self):
+        total = self.below + self.inside + self.above
+        return 100.0 * self.inside / total if total else 0.0
+
+    def summary(self):
+        # Columnas de TRIAL_COLUMNS que se guardan con el ensayo
+        if not self.count:
+            return {}
+        summary = {'Min HR': self.min, 'Max HR': self.max, 'HR SD': round(self.sd, 2)}
+        if self.zone:
+            summary.update({'Time Below Zone (s)': round(self.below, 2),
+                            'Time In Zone (s)': round(self.inside, 2),
+                            'Time Above Zone (s)': round(self.above, 2)})
+        return summary
+
+    def describe(self):
+        if not self.count:
+            return "Mean: -- | Min/Max: -- | SD: --"
+        text = f"Mean: {self.mean:.0f} | Min/Max: {self.min:.0f}/{self.max:.0f} | SD: {self.sd:.1f}"
+        if self.zone:
+            text += (f"\nZone: {self.in_zone_percent():.0f}% in | below {self.below:.0f} s,"
+                     f" in {self.inside:.0f} s, above {self.above:.0f} s")
+        return text
+
+
+# ---------------------------------------------------------------------------
+#                        GRÁFICA DE FC EN VIVO
+# ---------------------------------------------------------------------------
+# Eje vertical fijo para no redibujar al cambiar la escala; cada columna de
+# píxeles guarda primero/mínimo/máximo/último valor y se dibuja como una sola
+# línea, de modo que el número de elementos del Canvas no depende de la
+# duración del ensayo
+HR_CHART_RANGE = (40, 200)
+HR_CHART_INITIAL_SECONDS = 60.0
+HR_CHART_GRID = (60, 100, 140, 180)
+HR_CHART_MARGIN = 30
+HR_CHART_COLORS = ("#C0392B", "#2471A3", "#1E8449", "#7D3C98", "#B9770E")
+
+
+class HRChartSeries:
+    def __init__(self, source, cursor, color):
+        self.source = source
+        self.cursor = cursor
+        self.color = color
+        # Por columna: [primero, mínimo, máximo, último, unida a la anterior]
+        self.columns = []
+        self.items = []
+        # False tras un hueco sin señal: la siguiente columna no se une
+        self.continuous = False
+
+
+class HRChart:
+    def __init__(self, parent, width=560, height=180, bg="white"):
+        self.canvas = tk.Canvas(parent, width=width, height=height, bg=bg, highlightthickness=0)
+        self.width = width
+        self.height = height
+        self.plot_width = width - HR_CHART_MARGIN
+        self.origin = None
+        self.seconds_per_pixel = HR_CHART_INITIAL_SECONDS / self.plot_width
+        self.series = {}
+        self.zone = None
+        self.zone_item = None
+        self.canvas.create_rectangle(HR_CHART_MARGIN, 0, width - 1, height - 1, outline="#999")
+        for hr in HR_CHART_GRID:
+            y = self.y(hr)
+            self.canvas.create_line(HR_CHART_MARGIN, y, width, y, fill="#DDD", tags="grid")
+            self.canvas.create_text(HR_CHART_MARGIN - 4, y, text=str(hr), anchor="e",
+                                    font=("Arial", 8), fill="#666")
+        self.span_item = self.canvas.create_text(width - 4, height - 4, anchor="se",
+                                                 font=("Arial", 8), fill="#666")
+        self._update_span()
+
+    def pack(self, **kwargs):
+        self.canvas.pack(**kwargs)
+
+    def y(self, hr):
+        low, high = HR_CHART_RANGE
+        hr = min(max(hr, low), high)
+        return (self.height - 1) * (high - hr) / (high - low)
+
+    def set_zone(self, zone):
+        # Banda de la zona objetivo (70-90 % de la FC de reserva) del protocolo HIGH
+        self.zone = zone
+        if self.zone_item:
+            self.canvas.delete(self.zone_item)
+            self.zone_item = None
+        if zone:
+            self.zone_item = self.canvas.create_rectangle(
+                HR_CHART_MARGIN + 1, self.y(zone[1]), self.width - 1, self.y(zone[0]),
+                fill="#D5F5E3", outline="")
+            self.canvas.tag_lower(self.zone_item, "grid")
+
+    def start(self, origin, sources):
+        # Borra la traza anterior y empieza una nueva con el tiempo 0 en origin
+        for series in self.series.values():
+            self._delete_items(series)
+            self.canvas.delete("legend-" + str(id(series)))
+        self.series = {}
+        self.origin = origin
+        self.seconds_per_pixel = HR_CHART_INITIAL_SECONDS / self.plot_width
+        self._update_span()
+        for source in sources:
+            self.add_source(source)
 
     def stop(self):
-        self.running = False
-        if self.loop and self.loop.is_running():
-            self.loop.call_soon_threadsafe(self.loop.stop)
-        if self.thread:
-            self.thread.join()
-        self.loop = None
-        self.thread = None
+        # La traza se conserva en pantalla hasta el siguiente ensayo
+        self.update()
+        self.origin = None
+
+    def add_source(self, source):
+        if source.address in self.series:
+            return
+        color = HR_CHART_COLORS[len(self.series) % len(HR_CHART_COLORS)]
+        series = HRChartSeries(source, source.ring.cursor(), color)
+        self.series[source.address] = series
+        if len(self.series) > 1 or source.name:
+            self.canvas.create_text(HR_CHART_MARGIN + 6, 4 + 12 * (len(self.series) - 1), anchor="nw",
+                                    text=source.name or source.address, fill=color,
+                                    font=("Arial", 8, "bold"), tags="legend-" + str(id(series)))
+
+    def update(self, sources=()):
+        # Lee las muestras nuevas de cada fuente y añade o prolonga las columnas
+        if self.origin is None:
+            return
+        for source in sources:
+            self.add_source(source)
+        for series in self.series.values():
+            for _, timestamp, hr, _ in series.cursor.read():
+                self._add(series, timestamp - self.origin, hr)
+
+    def _add(self, series, elapsed, hr):
+        if elapsed < 0:
+            return
+        if hr is None:
+            series.continuous = False
+            return
+        column = int(elapsed / self.seconds_per_pixel)
+        while column >= self.plot_width:
+            self._rescale()
+            column = int(elapsed / self.seconds_per_pixel)
+        columns = series.columns
+        if column < len(columns) and columns[column]:
+            values = columns[column]
+            values[1] = min(values[1], hr)
+            values[2] = max(values[2], hr)
+            values[3] = hr
+        else:
+            while len(columns) <= column:
+                columns.append(None)
+                series.items.append(None)
+            values = columns[column] = [hr, hr, hr, hr, series.continuous]
+        series.continuous = True
+        self._draw(series, column)
+
+    def _draw(self, series, column):
+        # Una línea por columna: desde el último valor de la anterior (si no hay
+        # hueco) pasando por el primero, el mínimo, el máximo y el último
+        first, low, high, last, joined = series.columns[column]
+        x = HR_CHART_MARGIN + column
+        coords = []
+        previous = series.columns[column - 1] if column > 0 else None
+        if joined and previous:
+            coords += [x - 1, self.y(previous[3])]
+        # El medio píxel final hace visible una columna con un único valor
+        coords += [x, self.y(first), x, self.y(low), x, self.y(high), x, self.y(last) + 0.5]
+        item = series.items[column]
+        if item is None:
+            series.items[column] = self.canvas.create_line(*coords, fill=series.color, width=1.5)
+        else:
+            self.canvas.coords(item, *coords)
+
+    def _rescale(self):
+        # Se duplica la escala temporal y se fusionan las columnas de dos en dos;
+        # ocurre log2(duración) veces, por lo que el coste por muestra es constante
+        self.seconds_per_pixel *= 2
+        for series in self.series.values():
+            merged = []
+            for index in range(0, len(series.columns), 2):
+                pair = [values for values in series.columns[index:index + 2] if values]
+                if not pair:
+                    merged.append(None)
+                    continue
+                merged.append([pair[0][0], min(v[1] for v in pair), max(v[2] for v in pair),
+                               pair[-1][3], pair[0][4]])
+            self._delete_items(series)
+            series.columns = merged
+            series.items = [None] * len(merged)
+            for column, values in enumerate(merged):
+                if values:
+                    self._draw(series, column)
+        self._update_span()
+
+    def _delete_items(self, series):
+        items = [item for item in series.items if item]
+        if items:
+            self.canvas.delete(*items)
+
+    def _update_span(self):
+        self.canvas.itemconfig(self.span_item, text=f"{self.seconds_per_pixel * self.plot_width:.0f} s")
+
+
+# ---------------------------------------------------------------------------
+#                 FC EN REPOSO CON DETECCIÓN DE ESTADO ESTABLE
+# ---------------------------------------------------------------------------
+# La medición termina en cuanto la FC es estable (pendiente y desviación de la
+# ventana final por debajo de los umbrales), entre RESTING_MIN_SECONDS y
+# RESTING_MAX_SECONDS
+RESTING_MIN_SECONDS = 60.0
+RESTING_MAX_SECONDS = 180.0
+RESTING_WINDOW_SECONDS = 30.0
+RESTING_MAX_SLOPE = 1.0       # bpm/min
+RESTING_MAX_SD = 2.0          # bpm
+RESTING_HR_RANGE = (30, 220)
+# Un salto mayor que este respecto a la media de la ventana es un artefacto
+RESTING_MAX_JUMP = 15.0
+# Tantos saltos seguidos indican que la referencia es la errónea (p. ej. las
+# primeras muestras con la banda aún asentándose): se vacía la ventana
+RESTING_MAX_CONSECUTIVE_REJECTIONS = 5
+RESTING_MIN_WINDOW_SAMPLES = 5
+
+
+class RestingHRMeasurement:
+    # Se alimenta con cada notificación (instante, FC). La ventana deslizante
+    # guarda sumas de t, hr, t², t·hr y hr² para obtener la pendiente de la
+    # regresión y la desviación típica con O(1) por muestra.
+    def __init__(self, start, min_seconds=RESTING_MIN_SECONDS, max_seconds=RESTING_MAX_SECONDS,
+                 window_seconds=RESTING_WINDOW_SECONDS, max_slope=RESTING_MAX_SLOPE, max_sd=RESTING_MAX_SD):
+        self.start = start
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.window_seconds = window_seconds
+        self.max_slope = max_slope
+        self.max_sd = max_sd
+        self.window = deque()
+        self._sums = [0.0, 0.0, 0.0, 0.0, 0.0]
+        self.accepted = 0
+        self.rejected = 0
+        self.consecutive_rejections = 0
+        self.elapsed = 0.0
+        self.finished = False
+        self.criterion = None
+
+    def _update_sums(self, t, hr, sign):
+        sums = self._sums
+        sums[0] += sign * t
+        sums[1] += sign * hr
+        sums[2] += sign * t * t
+        sums[3] += sign * t * hr
+        sums[4] += sign * hr * hr
+
+    def add(self, timestamp, hr):
+        # hr es None en los huecos o sin contacto con la piel
+        if self.finished:
+            return
+        t = timestamp - self.start
+        self.elapsed = max(self.elapsed, t)
+        # La ventana avanza con el tiempo aunque se rechacen las muestras
+        self._evict(t)
+        if hr is None:
+            return
+        if not RESTING_HR_RANGE[0] <= hr <= RESTING_HR_RANGE[1]:
+            self.rejected += 1
+            return
+        n = len(self.window)
+        if n >= RESTING_MIN_WINDOW_SAMPLES and abs(hr - self._sums[1] / n) > RESTING_MAX_JUMP:
+            if self.consecutive_rejections + 1 < RESTING_MAX_CONSECUTIVE_REJECTIONS:
+                self.rejected += 1
+                self.consecutive_rejections += 1
+                return
+            # La FC se ha mantenido lejos de la ventana: se empieza de nuevo
+            self.window.clear()
+            self._sums = [0.0, 0.0, 0.0, 0.0, 0.0]
+        self.consecutive_rejections = 0
+        self.accepted += 1
+        self.window.append((t, hr))
+        self._update_sums(t, hr, 1)
+
+    def _evict(self, t):
+        # Quita las muestras anteriores a t - window_seconds
+        while self.window and self.window[0][0] < t - self.window_seconds:
+            old_t, old_hr = self.window.popleft()
+            self._update_sums(old_t, old_hr, -1)
+
+    def statistics(self):
+        # (media, pendiente en bpm/min, desviación típica) de la ventana actual
+        n = len(self.window)
+        if not n:
+            return None, None, None
+        sum_t, sum_hr, sum_tt, sum_thr, sum_hrhr = self._sums
+        mean = sum_hr / n
+        if n < 2:
+            return mean, None, None
+        var_t = sum_tt - sum_t * sum_t / n
+        slope = (sum_thr - sum_t * sum_hr / n) / var_t * 60.0 if var_t > 1e-9 else None
+        sd = max(sum_hrhr - sum_hr * sum_hr / n, 0.0) / (n - 1)
+        return mean, slope, sd ** 0.5
+
+    def window_span(self):
+        return self.window[-1][0] - self.window[0][0] if len(self.window) > 1 else 0.0
+
+    def check(self, now):
+        # Devuelve True cuando la medición ha terminado y fija criterion
+        if self.finished:
+            return True
+        self.elapsed = max(self.elapsed, now - self.start)
+        self._evict(now - self.start)
+        mean, slope, sd = self.statistics()
+        if (self.elapsed >= self.min_seconds and len(self.window) >= RESTING_MIN_WINDOW_SAMPLES
+                and self.window_span() >= 0.9 * self.window_seconds and slope is not None
+                and abs(slope) <= self.max_slope and sd <= self.max_sd):
+            self.criterion = (f"steady state after {self.elapsed:.0f} s: |slope| {abs(slope):.2f} <= "
+                              f"{self.max_slope} bpm/min, SD {sd:.2f} <= {self.max_sd} bpm over "
+                              f"{self.window_seconds:.0f} s")
+            self.finished = True
+        elif self.elapsed >= self.max_seconds:
+            self.criterion = f"maximum duration {self.max_seconds:.0f} s reached without steady state"
+            self.finished = True
+        return self.finished
+
+    def result(self):
+        # FC en reposo = media de la ventana final (estable)
+        mean = self.statistics()[0]
+        return round(mean, 2) if mean is not None else 0
+
+
+# ---------------------------------------------------------------------------
+#                   TIEMPO REAL DE LOS EVENTOS DE ENTRADA
+# ---------------------------------------------------------------------------
+EVENT_CLOCK_WINDOW = 512
+X_TIME_WRAP = 1 << 32
+
+
+class EventClock:
+    # Traduce el tiempo del servidor X de cada evento (event.time, ms) a
+    # time.perf_counter(). El desfase entre ambos relojes se estima como el
+    # mínimo de (llegada - tiempo X) en los últimos eventos observados: el
+    # evento que se despachó más rápido es el que mejor lo aproxima. La
+    # latencia de despacho de un evento es entonces llegada - instante real.
+    # La resolución está limitada al milisegundo del reloj X.
+    def __init__(self, window=EVENT_CLOCK_WINDOW):
+        self.offsets = deque(maxlen=window)
+        self._last_raw = None
+        self._wraps = 0
+
+    def _unwrap(self, raw):
+        # event.time es un entero de 32 bits que da la vuelta cada ~49 días
+        if self._last_raw is not None and raw < self._last_raw - X_TIME_WRAP // 2:
+            self._wraps += 1
+        self._last_raw = raw
+        return (raw + self._wraps * X_TIME_WRAP) / 1000.0
+
+    def observe(self, event, arrival=None):
+        # Enlazar a eventos frecuentes (teclas, ratón) para mantener la calibración
+        arrival = time.perf_counter() if arrival is None else arrival
+        raw = getattr(event, 'time', None)
+        if not isinstance(raw, int) or raw <= 0:
+            return None
+        x_time = self._unwrap(raw)
+        self.offsets.append(arrival - x_time)
+        return x_time
+
+    def event_time(self, event):
+        # Devuelve (instante real del evento en reloj monotónico, latencia de
+        # despacho en segundos); sin tiempo X válido se usa la llegada y la
+        # latencia queda como None
+        arrival = time.perf_counter()
+        x_time = self.observe(event, arrival)
+        if x_time is None:
+            return arrival, None
+        occurred = x_time + min(self.offsets)
+        return occurred, arrival - occurred
+
+
+# ---------------------------------------------------------------------------
+#                  PLANIFICADOR DE TAREAS PERIÓDICAS
+# ---------------------------------------------------------------------------
+class ScheduledJob:
+    __slots__ = ('name', 'period', 'callback', 'deadline', 'ticks', 'skipped', 'last_run')
+
+    def __init__(self, name, period, callback, deadline):
+        self.name = name
+        self.period = period
+        self.callback = callback
+        self.deadline = deadline
+        self.ticks = 0
+        self.skipped = 0
+        self.last_run = None
+
+
+class PeriodicScheduler:
+    # Todas las tareas periódicas de la interfaz con un solo temporizador de Tk.
+    # Los plazos son absolutos (inicio + n * periodo en time.perf_counter()),
+    # así que el retraso de una ejecución no se acumula en las siguientes. Si
+    # una tarea llega tarde más de un periodo, los plazos perdidos se cuentan
+    # en skipped en lugar de ejecutarse en ráfaga.
+    def __init__(self, root):
+        self.root = root
+        self.jobs = {}
+        self._timer = None
+        self._timer_deadline = None
+
+    def add(self, name, period, callback, start=None):
+        # callback(scheduled, now) se ejecuta en cada plazo; start es el primer plazo
+        job = ScheduledJob(name, period, callback, time.perf_counter() if start is None else start)
+        self.jobs[name] = job
+        self._arm()
+        return job
+
+    def cancel(self, name):
+        job = self.jobs.pop(name, None)
+        self._arm()
+        return job
+
+    def _arm(self):
+        if not self.jobs:
+            if self._timer:
+                self.root.after_cancel(self._timer)
+            self._timer = self._timer_deadline = None
+            return
+        deadline = min(job.deadline for job in self.jobs.values())
+        if self._timer and self._timer_deadline == deadline:
+            return
+        if self._timer:
+            self.root.after_cancel(self._timer)
+        delay = max(0, int((deadline - time.perf_counter()) * 1000))
+        self._timer = self.root.after(delay, self._run)
+        self._timer_deadline = deadline
+
+    def _run(self):
+        self._timer = self._timer_deadline = None
+        now = time.perf_counter()
+        try:
+            for job in [job for job in self.jobs.values() if job.deadline <= now]:
+                if self.jobs.get(job.name) is not job:
+                    continue
+                scheduled = job.deadline
+                missed = int((now - scheduled) / job.period)
+                job.skipped += missed
+                if missed:
+                    METRICS.increment("tk_skipped_ticks_total", missed, job=job.name)
+                job.ticks += 1
+                job.deadline = scheduled + (missed + 1) * job.period
+                job.last_run = now
+                METRICS.observe("tk_loop_lag_seconds", now - scheduled)
+                with METRICS.time("tk_job_seconds", job=job.name):
+                    job.callback(scheduled + missed * job.period, now)
+                now = time.perf_counter()
+        finally:
+            # Un error en una tarea no detiene las demás
+            self._arm()
+
+
+# ---------------------------------------------------------------------------
+#                    TABLA DE RESULTADOS VIRTUALIZADA
+# ---------------------------------------------------------------------------
+class PagedTrialTable:
+    # El Treeview solo contiene las filas visibles; al desplazarse, filtrar u
+    # ordenar se pide al almacén únicamente la página que se va a mostrar.
+    def __init__(self, parent, store, protocols, selectmode='browse', page_size=15):
+        self.store = store
+        self.selectmode = selectmode
+        self.page_size = page_size
+        # La selección se guarda por id de registro para conservarla entre páginas
+        self.selected = set()
+        self.first = 0
+        self.total = 0
+        self.sort_column = None
+        self.descending = False
+        self._pending_reload = None
+
+        filter_frame = tk.Frame(parent, bg="#E8F6F3")
+        filter_frame.pack(pady=5)
+        tk.Label(filter_frame, text="Participant:", font=("Arial", 10), bg="#E8F6F3").grid(row=0, column=0, padx=5)
+        self.participant_filter = tk.StringVar()
+        tk.Entry(filter_frame, textvariable=self.participant_filter, font=("Arial", 10)).grid(row=0, column=1, padx=5)
+        tk.Label(filter_frame, text="Protocol:", font=("Arial", 10), bg="#E8F6F3").grid(row=0, column=2, padx=5)
+        self.protocol_filter = tk.StringVar(value="All")
+        protocol_combobox = ttk.Combobox(filter_frame, textvariable=self.protocol_filter,
+                                         values=["All"] + list(protocols), state="readonly", width=10)
+        protocol_combobox.grid(row=0, column=3, padx=5)
+        self.participant_filter.trace_add('write', lambda *_: self.schedule_reload())
+        protocol_combobox.bind('<<ComboboxSelected>>', lambda _: self.reload())
+
+        table_frame = tk.Frame(parent)
+        table_frame.pack(pady=5, padx=10, fill='both', expand=True)
+        self.tree = ttk.Treeview(table_frame, selectmode=selectmode, height=page_size)
+        self.tree['columns'] = tuple(TRIAL_TABLE_COLUMNS)
+        self.tree.column('#0', width=0, stretch=tk.NO)
+        for column, anchor, width in zip(TRIAL_TABLE_COLUMNS, (tk.W, tk.W, tk.CENTER, tk.CENTER, tk.CENTER),
+                                         (120, 120, 100, 80, 80)):
+            self.tree.column(column, anchor=anchor, width=width)
+            self.tree.heading(column, text=column, anchor=anchor, command=lambda c=column: self.sort_by(c))
+        self.tree.heading('#0', text='', anchor=tk.W)
+        self.scrollbar = ttk.Scrollbar(table_frame, orient=tk.VERTICAL, command=self.on_scroll)
+        self.tree.pack(side=tk.LEFT, fill='both', expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.bind('<MouseWheel>', lambda event: self.scroll_by(-1 if event.delta > 0 else 1))
+        self.tree.bind('<Button-4>', lambda _: self.scroll_by(-1))
+        self.tree.bind('<Button-5>', lambda _: self.scroll_by(1))
+        self.tree.bind('<Prior>', lambda _: self.scroll_by(-self.page_size))
+        self.tree.bind('<Next>', lambda _: self.scroll_by(self.page_size))
+        self.tree.bind('<<TreeviewSelect>>', self.on_select)
+
+        self.status_label = tk.Label(parent, text="", font=("Arial", 10), bg="#E8F6F3")
+        self.status_label.pack()
+        self.reload()
+
+    def query(self):
+        participant = self.participant_filter.get().strip() or None
+        protocol = self.protocol_filter.get()
+        return {
+            "participant": participant,
+            "protocol": None if protocol == "All" else protocol,
+        }
+
+    def schedule_reload(self, delay=300):
+        # Espera a que se deje de escribir antes de volver a filtrar
+        if self._pending_reload:
+            self.tree.after_cancel(self._pending_reload)
+        self._pending_reload = self.tree.after(delay, self.reload)
+
+    def reload(self):
+        self._pending_reload = None
+        self.total = self.store.count(**self.query())
+        self.render()
+
+    def sort_by(self, column):
+        if self.sort_column == column:
+            self.descending = not self.descending
+        else:
+            self.sort_column = column
+            self.descending = False
+        for name in TRIAL_TABLE_COLUMNS:
+            arrow = (" \u25bc" if self.descending else " \u25b2") if name == self.sort_column else ""
+            self.tree.heading(name, text=name + arrow)
+        self.render()
+
+    def scroll_by(self, rows):
+        self.first += rows
+        self.render()
+        return "break"
+
+    def on_scroll(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.first = int(float(amount) * self.total)
+        elif unit == 'pages':
+            self.first += int(amount) * self.page_size
+        else:
+            self.first += int(amount)
+        self.render()
+
+    def on_select(self, _event=None):
+        current = {int(item) for item in self.tree.selection()}
+        if self.selectmode == 'extended':
+            visible = {int(item) for item in self.tree.get_children()}
+            self.selected = (self.selected - visible) | current
+        else:
+            self.selected = current
+        self.update_status()
+
+    def render(self):
+        self.first = max(0, min(self.first, self.total - self.page_size))
+        query = self.query()
+        rows = self.store.page(self.first, self.page_size, sort_column=self.sort_column,
+                               descending=self.descending, **query)
+        self.tree.delete(*self.tree.get_children())
+        for record_id, row in rows:
+            self.tree.insert('', 'end', iid=record_id, values=tuple(row[:len(TRIAL_TABLE_COLUMNS)]))
+        visible_selected = [record_id for record_id, _ in rows if record_id in self.selected]
+        if visible_selected:
+            self.tree.selection_set(visible_selected)
+        if self.total:
+            self.scrollbar.set(self.first / self.total, min(1.0, (self.first + self.page_size) / self.total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+        self.update_status()
+
+    def update_status(self):
+        if not self.total:
+            self.status_label.config(text="No matching rows")
+            return
+        last = min(self.total, self.first + self.page_size)
+        text = f"Rows {self.first + 1}-{last} of {self.total}"
+        if len(self.selected) > 1:
+            text += f" ({len(self.selected)} selected)"
+        self.status_label.config(text=text)
+
+    def selection(self):
+        return sorted(self.selected)
+
+    def clear_selection(self):
+        self.selected = set()
+        self.reload()
 
 
 class StopwatchApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Testing Time Estimation")
-        self.root.geometry("600x500")
+        self.root.geometry("600x760")
         self.root.configure(bg="#E8F6F3")
 
-        pygame.mixer.init()
+        self.startup = StartupTimer()
+        self.startup.mark("imports + Tk")
         self.initialize_paths()
+        self.initialize_storage()
+        self.startup.mark("storage")
         self.initialize_variables()
+        self.startup.mark("variables + images")
         self.create_ui_elements()
         self.create_menu()
+        self.startup.mark("widgets + menu")
         self.create_csv_file_if_not_exists()
         self.bind_keys()
+        self.startup.mark("results file + keys")
 
         # Inicialmente, ningún dispositivo HR está conectado
+        self.ble_manager = get_ble_manager()
         self.hr_monitor = None
+        self.scan_window = None
+        self.known_devices = KnownDeviceCache(os.path.join(self.data_directory, KNOWN_DEVICES_FILENAME))
+        self.reconnect_known_device()
         self.hr_rest = None  # Aquí se almacenará el HR en reposo
 
-        # Actualiza la etiqueta de HR en tiempo real
-        self.update_hr_label()
+        # Las muestras nuevas despiertan a la interfaz; la consulta periódica solo
+        # refleja los cambios de estado de la conexión cuando no llegan muestras
+        self.hr_waker = UIWaker(self.on_hr_samples, self.scheduler)
+        self.ble_manager.add_waker(self.hr_waker.notify)
+        self.scheduler.add('hr_label', 1.0, self.update_hr_label)
+        # Compactación del CSV de resultados cuando la aplicación está ociosa
+        self.compaction_thread = None
+        self.trial_windows = set()
+        self.export_job = None
+        self.root.after(IDLE_COMPACTION_INTERVAL_MS, self.compact_when_idle)
+        self.startup.mark("devices + scheduler")
+        # El sonido se carga cuando la ventana ya se ha dibujado
+        self.root.after_idle(self.finish_startup)
+
+    def finish_startup(self):
+        self.startup.mark("first draw")
+        self.load_start_cue()
+        self.startup.mark("audio (deferred)")
+        self.startup.report()
+
+    def load_start_cue(self):
+        if self.start_cue is None:
+            self.start_cue = StartCue(self.start_sound)
+        return self.start_cue
 
     def initialize_paths(self):
         current_directory = os.path.dirname(os.path.abspath(__file__))
@@ -99,6 +3370,12 @@ class StopwatchApp:
         self.assets_directory = assets_directory
         self.data_directory   = data_directory
 
+    def initialize_storage(self):
+        # CSV/JSON por defecto; SQLite si TIME_APP_STORAGE=sqlite
+        self.storage = open_storage(self.data_directory, self.participants_file, self.filename)
+        self.participants_repo = self.storage.participants
+        self.trial_store = self.storage.trials
+
     def initialize_variables(self):
         self.start_time = None
         self.running = False
@@ -106,16 +3383,24 @@ class StopwatchApp:
         self.protocols = ["CONTROL", "HIGH"]
         # El archivo de FC se definirá tras seleccionar el participante
         self.hr_filename = None
+        self.hr_writer = None
+        self.event_clock = EventClock()
+        self.start_cue = None
+        self.scheduler = PeriodicScheduler(self.root)
+        # Métricas de auditoría del ensayo en curso (columnas extra de TRIAL_COLUMNS)
+        self.trial_metrics = {}
         # Carga de imágenes
         self.clock_image = PhotoImage(file=self.clock_image_path)
-        self.clock_gif   = Image.open(self.clock_gif_path)
-        self.clock_gif_frames = [
-            ImageTk.PhotoImage(frame.copy().convert('RGBA'))
-            for frame in ImageSequence.Iterator(self.clock_gif)
-        ]
+        self.clock_gif_frames = LazyGifFrames(
+            self.clock_gif_path, on_loaded=lambda seconds: self.startup.add("GIF decoding", seconds))
         self.current_frame_index = 0
-        # Lista para guardar las lecturas de FC
-        self.hr_readings = []
+        # Estadísticos de FC del ensayo en curso y zona objetivo (solo HIGH)
+        self.target_zone = None
+        self.hr_stats = HRTrialStats()
+        # (monitor, fase de HRV) del ensayo en curso
+        self.trial_hrv = None
+        # Cursor del anillo de muestras del ensayo en curso
+        self.trial_cursor = None
 
     def create_ui_elements(self):
         self.clock_label = tk.Label(self.root, image=self.clock_image, bg="#E8F6F3")
@@ -188,6 +3473,18 @@ class StopwatchApp:
             fg="#333"
         )
         self.hr_label.pack(pady=5)
+        # Estadísticos en vivo y cumplimiento de la zona objetivo
+        self.hr_stats_label = tk.Label(
+            self.root,
+            text="",
+            font=("Arial", 11),
+            bg="#E8F6F3",
+            fg="#333"
+        )
+        self.hr_stats_label.pack(pady=2)
+        # Traza de FC del ensayo frente a la zona objetivo
+        self.hr_chart = HRChart(self.root)
+        self.hr_chart.pack(pady=5)
 
     def create_menu(self):
         menubar = Menu(self.root)
@@ -202,9 +3499,13 @@ class StopwatchApp:
         data_menu.add_command(label="View Data", command=self.view_data)
         data_menu.add_command(label="Delete Data Record", command=self.delete_data_record)
         data_menu.add_command(label="Export to Excel", command=self.export_to_excel)
+        data_menu.add_command(label="Compact Data File", command=self.compact_data_file)
         devices_menu = Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Devices", menu=devices_menu)
         devices_menu.add_command(label="Scan HR Device", command=self.scan_for_devices)
+        devices_menu.add_command(label="Connected Devices", command=self.view_connected_devices)
+        devices_menu.add_command(label="Add Simulated Devices", command=self.add_simulated_devices)
+        devices_menu.add_command(label="Replay HR Trace", command=self.replay_hr_trace)
         devices_menu.add_command(label="Measure Resting HR", command=self.measure_resting_hr)
         exit_menu = Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Exit", menu=exit_menu)
@@ -212,27 +3513,28 @@ class StopwatchApp:
 
     def bind_keys(self):
         self.root.bind('<space>', self.stop_stopwatch)
+        # Ventana de diagnóstico oculta (no aparece en los menús)
+        self.root.bind('<Control-Shift-D>', lambda event: self.show_diagnostics())
+        # Cualquier tecla o movimiento del ratón calibra el reloj de eventos
+        for sequence in ('<KeyPress>', '<ButtonPress>', '<Motion>'):
+            self.root.bind_all(sequence, self.event_clock.observe, add='+')
 
     def create_csv_file_if_not_exists(self):
-        if not os.path.exists(self.filename):
-            with open(self.filename, mode='w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file, delimiter=';')
-                writer.writerow(['Participant', 'Protocol', 'Time (seconds)', 'RPE', 'Mean HR'])
+        self.trial_store.create_if_not_exists()
 
     # ---------------------------------------------------------------------------
     #           MÉTODO PARA MEDIR HR REST EN REPOSO (3 minutos) Y ACTUALIZAR PARTICIPANTES
     # ---------------------------------------------------------------------------
     def measure_resting_hr(self):
         # Abre una ventana para elegir el participante al que medir HRrest
-        if not os.path.exists(self.participants_file):
+        if not self.participants_repo.exists():
             messagebox.showwarning("No Participants", "No participants available.")
             return
         select_window = tk.Toplevel(self.root)
         select_window.title("Select Participant for Resting HR")
         select_window.geometry("600x400")
         select_window.configure(bg="#E8F6F3")
-        with open(self.participants_file, 'r') as file:
-            participants = json.load(file)
+        participants = self.participants_repo.all()
         if not participants:
             messagebox.showwarning("No Participants", "No participants available.")
             return
@@ -275,44 +3577,57 @@ class StopwatchApp:
             return
         measure_window = tk.Toplevel(self.root)
         measure_window.title("Measure Resting HR")
-        measure_window.geometry("400x200")
+        measure_window.geometry("450x220")
         measure_window.configure(bg="#E8F6F3")
         instructions = tk.Label(measure_window,
-                                  text="Please sit calmly for 3 minutes.\nMeasuring resting HR...",
+                                  text=f"Please sit calmly ({RESTING_MIN_SECONDS / 60:.0f}-{RESTING_MAX_SECONDS / 60:.0f} minutes).\nMeasuring resting HR...",
                                   font=("Arial", 12), bg="#E8F6F3")
         instructions.pack(pady=10)
         timer_label = tk.Label(measure_window,
-                               text="180 seconds remaining",
+                               text="Waiting for HR...",
                                font=("Arial", 12, "bold"), bg="#E8F6F3")
         timer_label.pack(pady=10)
-        hr_values = []
-        total_time = 180  # 3 minutos
-        def update_timer(remaining):
-            if remaining <= 0:
-                avg_hr = round(sum(hr_values) / len(hr_values), 2) if hr_values else 0
-                self.update_participant_hrrest(self.selected_resting_participant, avg_hr)
-                messagebox.showinfo("Measurement Complete", f"Resting HR measured: {avg_hr} bpm")
+        monitor = self.hr_monitor
+        hrv_phase = monitor.hrv.start_phase()
+        # Cada notificación entra en la medición a través de un cursor del anillo
+        measurement = RestingHRMeasurement(time.perf_counter())
+        cursor = monitor.ring.cursor()
+        def finish():
+            self.scheduler.cancel('resting_hr')
+            return monitor.hrv.end_phase(hrv_phase)
+        def update_timer(scheduled, now):
+            if not measure_window.winfo_exists():
+                finish()
+                return
+            for _, timestamp, hr, _ in cursor.read():
+                measurement.add(timestamp, hr)
+            if measurement.check(now):
+                hrv = finish()
+                resting_hr = measurement.result()
+                print("FC en reposo:", resting_hr, "-", measurement.criterion)
+                self.update_participant_hrrest(self.selected_resting_participant, resting_hr, hrv, measurement)
+                messagebox.showinfo("Measurement Complete",
+                                    f"Resting HR measured: {resting_hr} bpm\n({measurement.criterion})")
                 measure_window.destroy()
             else:
-                timer_label.config(text=f"{remaining} seconds remaining")
-                hr_values.append(self.hr_monitor.current_hr)
-                measure_window.after(1000, lambda: update_timer(remaining - 1))
-        update_timer(total_time)
+                mean, slope, sd = measurement.statistics()
+                text = f"{measurement.elapsed:.0f} s (max {RESTING_MAX_SECONDS:.0f} s)"
+                if mean is not None and slope is not None:
+                    text += f"\nHR {mean:.0f} bpm | slope {slope:+.1f} bpm/min | SD {sd:.1f}"
+                timer_label.config(text=text)
+        self.scheduler.add('resting_hr', 0.5, update_timer)
 
-    def update_participant_hrrest(self, participant_record, hrrest_value):
-        # Actualiza el campo "HRrest" en participants.json y en la variable interna
-        if not os.path.exists(self.participants_file):
+    def update_participant_hrrest(self, participant_record, hrrest_value, hrv=None, measurement=None):
+        # Actualiza el campo "HRrest" (y la HRV en reposo y el criterio de parada)
+        # en participants.json y en la variable interna
+        if not self.participants_repo.exists():
             return
-        with open(self.participants_file, 'r') as file:
-            participants = json.load(file)
-        for participant in participants:
-            if (participant.get("First Name") == participant_record.get("First Name") and
-                participant.get("Last Name") == participant_record.get("Last Name") and
-                participant.get("Birth Date") == participant_record.get("Birth Date")):
-                participant["HRrest"] = hrrest_value
-                break
-        with open(self.participants_file, 'w') as file:
-            json.dump(participants, file, indent=4)
+        fields = hrv_columns(hrv, 'Resting ') if hrv else {}
+        if measurement:
+            fields.update({"Resting Duration (s)": round(measurement.elapsed, 1),
+                           "Resting Rejected Samples": measurement.rejected,
+                           "Resting Criterion": measurement.criterion})
+        self.participants_repo.update(participant_record, HRrest=hrrest_value, **fields)
         # Actualiza la variable interna para el HR en reposo
         self.hr_rest = hrrest_value
 
@@ -324,11 +3639,10 @@ class StopwatchApp:
         select_window.title("Select Participant")
         select_window.geometry("600x400")
         select_window.configure(bg="#E8F6F3")
-        if not os.path.exists(self.participants_file):
+        if not self.participants_repo.exists():
             messagebox.showwarning("Warning", "No participants available.")
             return
-        with open(self.participants_file, 'r') as file:
-            participants = json.load(file)
+        participants = self.participants_repo.all()
         if not participants:
             messagebox.showwarning("Warning", "No participants available.")
             return
@@ -371,12 +3685,13 @@ class StopwatchApp:
     def setup_hr_file(self):
         if not hasattr(self, 'participant_var'):
             return
-        filename = f"hr_data_{self.participant_var.replace(' ', '_')}.csv"
-        self.hr_filename = os.path.join(self.data_directory, filename)
-        if not os.path.exists(self.hr_filename):
-            with open(self.hr_filename, 'w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file, delimiter=';')
-                writer.writerow(['Protocol', 'Elapsed Time (s)', 'HR (bpm)'])
+        # Un escritor en segundo plano por participante
+        if self.hr_writer and self.hr_writer.participant != self.participant_var:
+            self.hr_writer.close()
+            self.hr_writer = None
+        if not self.hr_writer:
+            self.hr_writer = self.storage.open_hr_log(self.participant_var)
+        self.hr_filename = self.hr_writer.filename
 
     def add_participant(self):
         add_window = tk.Toplevel(self.root)
@@ -434,33 +3749,16 @@ class StopwatchApp:
         accept_button.pack(pady=20)
 
     def is_duplicate_general(self, participant_info):
-        if os.path.exists(self.participants_file):
-            with open(self.participants_file, 'r') as file:
-                participants = json.load(file)
-                for p in participants:
-                    if (p["First Name"] == participant_info["First Name"] and
-                        p["Last Name"] == participant_info["Last Name"] and
-                        p["Birth Date"] == participant_info["Birth Date"] and
-                        p["Sex"] == participant_info["Sex"]):
-                        return True
-        return False
+        return self.participants_repo.is_duplicate(participant_info)
 
     def save_participant_info(self, participant_info):
-        if os.path.exists(self.participants_file):
-            with open(self.participants_file, 'r') as file:
-                participants = json.load(file)
-        else:
-            participants = []
-        participants.append(participant_info)
-        with open(self.participants_file, 'w') as file:
-            json.dump(participants, file, indent=4)
+        self.participants_repo.add(participant_info)
 
     def view_participants(self):
-        if not os.path.exists(self.participants_file):
+        if not self.participants_repo.exists():
             messagebox.showwarning("Warning", "No participants available.")
             return
-        with open(self.participants_file, 'r') as file:
-            participants = json.load(file)
+        participants = self.participants_repo.all()
         if not participants:
             messagebox.showwarning("Warning", "No participants available.")
             return
@@ -493,11 +3791,10 @@ class StopwatchApp:
         delete_window.title("Delete Participant")
         delete_window.geometry("600x400")
         delete_window.configure(bg="#E8F6F3")
-        if not os.path.exists(self.participants_file):
+        if not self.participants_repo.exists():
             messagebox.showwarning("Warning", "No participants available.")
             return
-        with open(self.participants_file, 'r') as file:
-            participants = json.load(file)
+        participants = self.participants_repo.all()
         if not participants:
             messagebox.showwarning("Warning", "No participants available.")
             return
@@ -527,9 +3824,7 @@ class StopwatchApp:
                 messagebox.showwarning("Warning", "Please select a participant to delete.")
                 return
             participant_index = int(selected_item[0])
-            participants.pop(participant_index)
-            with open(self.participants_file, 'w') as file:
-                json.dump(participants, file, indent=4)
+            self.participants_repo.remove(participants[participant_index])
             messagebox.showinfo("Success", "Participant deleted successfully.")
             delete_window.destroy()
         delete_button = tk.Button(delete_window, text="Delete Selected", command=confirm_delete,
@@ -554,117 +3849,149 @@ class StopwatchApp:
         self.confirm_button.config(state=tk.DISABLED)
         self.cancel_button.config(state=tk.NORMAL)
         self.protocol_menu.config(state=tk.DISABLED)
+        self.target_zone = None
         if self.protocol_var.get() == "HIGH":
             record = self.get_participant_record()
             if record and "HRrest" in record:
                 self.hr_rest = record["HRrest"]
             if self.hr_rest is not None:
                 age = self.calculate_age(record["Birth Date"])
-                hrmax = 220 - age
-                hrr = hrmax - self.hr_rest
-                target_low = self.hr_rest + (hrr * 0.70)
-                target_high = self.hr_rest + (hrr * 0.90)
+                target_low, target_high = hr_target_zone(self.hr_rest, age)
+                self.target_zone = (target_low, target_high)
                 self.result_label.config(text=f"Resting HR: {self.hr_rest} bpm, Age: {age} years.\nTarget HR: {int(target_low)} - {int(target_high)} bpm")
             else:
                 self.result_label.config(text="Please measure resting HR before starting HIGH protocol.")
         else:
             self.result_label.config(text="Press 'Start' to begin testing.")
+        self.hr_chart.set_zone(self.target_zone)
 
     def get_participant_record(self):
-        if not os.path.exists(self.participants_file):
-            return None
-        with open(self.participants_file, 'r') as file:
-            participants = json.load(file)
-        for p in participants:
-            name = f"{p.get('First Name', '')} {p.get('Last Name', '')}"
-            if name == self.participant_var:
-                return p
-        return None
+        return self.participants_repo.find_by_name(self.participant_var)
 
     def calculate_age(self, birthdate_str):
-        import datetime
-        birth_date = datetime.datetime.strptime(birthdate_str, '%d/%m/%Y').date()
-        today = datetime.date.today()
-        age = today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
-        return age
+        return participant_age(birthdate_str)
 
     def is_duplicate(self, participant_id, protocol):
-        if os.path.exists(self.filename):
-            with open(self.filename, mode='r', newline='', encoding='utf-8') as file:
-                reader = csv.reader(file, delimiter=';')
-                next(reader)  # Saltamos cabecera
-                for row in reader:
-                    if row[0] == participant_id and row[1] == protocol:
-                        return True
-        return False
+        return self.trial_store.contains(participant_id, protocol)
 
     def start_stopwatch(self):
         if self.protocol_var.get() == "HIGH":
             if self.hr_rest is None:
                 messagebox.showwarning("Missing HRrest", "Please measure resting HR before starting the HIGH protocol.")
                 return
-        pygame.mixer.music.load(self.start_sound)
-        pygame.mixer.music.play()
-        self.start_time = time.perf_counter()
+        # El tiempo empieza a contar cuando la señal empieza a oírse
+        self.start_time, cue_latency = self.load_start_cue().play()
         self.running = True
-        self.hr_readings = []
+        self.hr_stats = HRTrialStats(self.target_zone if self.protocol_var.get() == "HIGH" else None)
+        self.trial_hrv = (self.hr_monitor, self.hr_monitor.hrv.start_phase()) if self.hr_monitor else None
+        # Se registran todas las notificaciones del pulsómetro desde este punto
+        self.trial_cursor = self.hr_monitor.ring.cursor() if self.hr_monitor else None
+        self.hr_chart.start(self.start_time, self.chart_sources())
+        self.hr_stats_label.config(text=self.live_stats_text())
+        self.trial_metrics = {'Cue Latency (ms)': round(cue_latency * 1000, 2)}
         self.update_ui_for_running_stopwatch()
-        self.animate_gif()
-        self.record_hr()
+        self.scheduler.add('animate_gif', 0.2, self.animate_gif)
 
     def update_ui_for_running_stopwatch(self):
         self.result_label.config(text="Stopwatch running...")
         self.start_button.config(state=tk.DISABLED)
         self.cancel_button.config(state=tk.DISABLED)
 
-    def record_hr(self):
+    def record_hr(self, until=None):
+        # Escribe cada muestra nueva del anillo con su instante real; las
+        # muestras sin valor (huecos de señal) se escriben como celda vacía
+        if not self.trial_cursor:
+            return
+        protocol = self.protocol_var.get()
+        with METRICS.time("file_op_seconds", op="record_hr"):
+            for _, timestamp, hr, _ in self.trial_cursor.read():
+                if until is not None and timestamp > until:
+                    break
+                elapsed_time = max(0.0, timestamp - self.start_time)
+                self.hr_stats.add(elapsed_time, hr)
+                if self.hr_writer:
+                    self.hr_writer.write((protocol, round(elapsed_time, 2), hr))
+        self.hr_stats_label.config(text=self.live_stats_text())
+
+    def on_hr_samples(self):
+        # Se ejecuta en el hilo de Tk cuando el hilo BLE publica muestras nuevas
+        latest = self.hr_monitor.ring.latest() if self.hr_monitor else None
+        if latest:
+            METRICS.observe("hr_sample_delivery_seconds", time.perf_counter() - latest[1])
+        self.update_hr_label()
         if self.running:
-            current_hr = 0
-            if self.hr_monitor:
-                current_hr = self.hr_monitor.current_hr
-            elapsed_time = time.perf_counter() - self.start_time
-            self.hr_readings.append(current_hr)
-            if self.hr_filename:
-                with open(self.hr_filename, 'a', newline='', encoding='utf-8') as file:
-                    writer = csv.writer(file, delimiter=';')
-                    writer.writerow([
-                        self.protocol_var.get(),
-                        round(elapsed_time, 2),
-                        current_hr
-                    ])
-            self.root.after(1000, self.record_hr)
-
-    def animate_gif(self):
+            self.record_hr()
+            self.hr_chart.update(self.chart_sources())
+
+    def chart_sources(self):
+        # Todas las fuentes conectadas se dibujan, no solo la seleccionada
+        return [monitor for monitor in list(self.ble_manager.monitors.values()) if monitor.running]
+
+    def animate_gif(self, scheduled, now):
         if self.running and self.clock_gif_frames:
             self.current_frame_index = (self.current_frame_index + 1) % len(self.clock_gif_frames)
             self.clock_label.config(image=self.clock_gif_frames[self.current_frame_index])
-            self.root.after(200, self.animate_gif)
+
+    def live_stats_text(self):
+        text = self.hr_stats.describe()
+        if self.trial_hrv:
+            hrv = self.trial_hrv[0].hrv.window_metrics()
+            if hrv['rmssd'] is not None:
+                text += f"\nRMSSD: {hrv['rmssd']:.0f} ms | SDNN: {hrv['sdnn']:.0f} ms | pNN50: {hrv['pnn50']:.0f}%"
+        return text
+
+    def stop_periodic_trial_jobs(self, end_time=None):
+        self.scheduler.cancel('animate_gif')
+        self.hr_chart.stop()
+        if self.trial_cursor:
+            # Últimas muestras hasta el instante de parada
+            self.record_hr(until=end_time)
+            self.trial_metrics['Skipped HR Samples'] = self.trial_cursor.lost
+            self.trial_cursor = None
+        if self.trial_hrv:
+            monitor, phase = self.trial_hrv
+            self.trial_metrics.update(hrv_columns(monitor.hrv.end_phase(phase)))
+            self.trial_hrv = None
 
     def stop_stopwatch(self, event):
         if self.running:
-            end_time = time.perf_counter()
+            # Instante en que se pulsó la tecla, no en el que Tk despachó el evento
+            end_time, latency = self.event_clock.event_time(event)
             elapsed_time = end_time - self.start_time
             self.running = False
+            self.stop_periodic_trial_jobs(end_time)
+            if latency is not None:
+                self.trial_metrics['Stop Latency (ms)'] = round(latency * 1000, 2)
+            if self.hr_writer:
+                self.hr_writer.flush()
             self.clock_label.configure(image=self.clock_image)
             self.collect_additional_data(elapsed_time)
 
     def collect_additional_data(self, elapsed_time):
         formatted_time = round(elapsed_time, 2)
         rpe = simpledialog.askinteger("RPE", "Enter RPE (6-20):", parent=self.root)
-        mean_hr = round(sum(self.hr_readings) / len(self.hr_readings), 2) if self.hr_readings else 0
+        mean_hr = round(self.hr_stats.mean, 2) if self.hr_stats.count else 0
+        self.trial_metrics.update(self.hr_stats.summary())
         self.save_record(formatted_time, rpe, mean_hr)
         self.reset_ui_after_test()
+        self.report_dropped_hr_rows()
+
+    def report_dropped_hr_rows(self):
+        if not self.hr_writer:
+            return
+        dropped = self.hr_writer.take_dropped()
+        if dropped:
+            messagebox.showwarning("HR Log", f"{dropped} HR samples could not be written to {self.hr_filename}.")
 
     def save_record(self, time_elapsed, rpe, mean_hr):
-        with open(self.filename, 'a', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file, delimiter=';')
-            writer.writerow([
+        with METRICS.time("file_op_seconds", op="save_record"):
+            self.trial_store.append([
                 self.participant_var,
                 self.protocol_var.get(),
                 time_elapsed,
                 rpe,
                 mean_hr
-            ])
+            ] + [self.trial_metrics.get(column, '') for column in TRIAL_COLUMNS[len(TRIAL_TABLE_COLUMNS):]])
 
     def reset_ui_after_test(self):
         self.protocol_menu.config(state=tk.NORMAL)
@@ -682,160 +4009,459 @@ class StopwatchApp:
         self.result_label.config(text="Test canceled. Ready for new input.")
         self.clock_label.configure(image=self.clock_image)
         self.running = False
+        self.stop_periodic_trial_jobs()
+        if self.hr_writer:
+            self.hr_writer.flush()
+        self.report_dropped_hr_rows()
 
     # ---------------------------------------------------------------------------
     #                           GESTIÓN DE DATOS
     # ---------------------------------------------------------------------------
     def view_data(self):
-        if not os.path.exists(self.filename):
+        if not self.trial_store.exists():
             messagebox.showwarning("Warning", "No data available.")
             return
         data_window = tk.Toplevel(self.root)
         data_window.title("Stored Data")
-        data_window.geometry("600x400")
-        tree = ttk.Treeview(data_window)
-        tree['columns'] = ('Participant', 'Protocol', 'Time (seconds)', 'RPE', 'Mean HR')
-        tree.column('#0', width=0, stretch=tk.NO)
-        tree.column('Participant', anchor=tk.W, width=120)
-        tree.column('Protocol', anchor=tk.W, width=120)
-        tree.column('Time (seconds)', anchor=tk.CENTER, width=100)
-        tree.column('RPE', anchor=tk.CENTER, width=80)
-        tree.column('Mean HR', anchor=tk.CENTER, width=80)
-        tree.heading('#0', text='', anchor=tk.W)
-        tree.heading('Participant', text='Participant', anchor=tk.W)
-        tree.heading('Protocol', text='Protocol', anchor=tk.W)
-        tree.heading('Time (seconds)', text='Time (seconds)', anchor=tk.CENTER)
-        tree.heading('RPE', text='RPE', anchor=tk.CENTER)
-        tree.heading('Mean HR', text='Mean HR', anchor=tk.CENTER)
-        with open(self.filename, mode='r', newline='', encoding='utf-8') as file:
-            reader = csv.reader(file, delimiter=';')
-            next(reader)
-            for row in reader:
-                tree.insert('', 'end', values=(row[0], row[1], row[2], row[3], row[4]))
-        tree.pack(pady=10, padx=10, fill='both', expand=True)
+        data_window.geometry("600x500")
+        data_window.configure(bg="#E8F6F3")
+        self.track_trial_window(data_window)
+        PagedTrialTable(data_window, self.trial_store, self.protocols, selectmode='extended')
+
+    def track_trial_window(self, window):
+        # Los ids de los registros CSV son desplazamientos en bytes que cambian al
+        # compactar: no se compacta mientras haya una tabla de resultados abierta
+        self.trial_windows.add(window)
+        def forget(event):
+            if event.widget is window:
+                self.trial_windows.discard(window)
+        window.bind('<Destroy>', forget, add='+')
 
     def delete_data_record(self):
-        if not os.path.exists(self.filename):
+        if not self.trial_store.exists():
             messagebox.showwarning("Warning", "No data available.")
             return
         delete_window = tk.Toplevel(self.root)
         delete_window.title("Delete Data Record")
-        delete_window.geometry("600x400")
-        tree = ttk.Treeview(delete_window, selectmode='browse')
-        tree['columns'] = ('Participant', 'Protocol', 'Time (seconds)', 'RPE', 'Mean HR')
-        tree.column('#0', width=0, stretch=tk.NO)
-        tree.column('Participant', anchor=tk.W, width=120)
-        tree.column('Protocol', anchor=tk.W, width=120)
-        tree.column('Time (seconds)', anchor=tk.CENTER, width=100)
-        tree.column('RPE', anchor=tk.CENTER, width=80)
-        tree.column('Mean HR', anchor=tk.CENTER, width=80)
-        tree.heading('#0', text='', anchor=tk.W)
-        tree.heading('Participant', text='Participant', anchor=tk.W)
-        tree.heading('Protocol', text='Protocol', anchor=tk.W)
-        tree.heading('Time (seconds)', text='Time (seconds)', anchor=tk.CENTER)
-        tree.heading('RPE', text='RPE', anchor=tk.CENTER)
-        tree.heading('Mean HR', text='Mean HR', anchor=tk.CENTER)
-        with open(self.filename, mode='r', newline='', encoding='utf-8') as file:
-            all_rows = list(csv.reader(file, delimiter=';'))
-            header = all_rows[0]
-            data = all_rows[1:]
-            for i, row in enumerate(data):
-                tree.insert('', 'end', iid=i, values=(row[0], row[1], row[2], row[3], row[4]))
-        tree.pack(pady=10, padx=10, fill='both', expand=True)
+        delete_window.geometry("600x550")
+        delete_window.configure(bg="#E8F6F3")
+        self.track_trial_window(delete_window)
+        table = PagedTrialTable(delete_window, self.trial_store, self.protocols, selectmode='extended')
         def confirm_delete():
-            selected_item = tree.selection()
-            if not selected_item:
+            selected_items = table.selection()
+            if not selected_items:
                 messagebox.showwarning("Warning", "Please select a record to delete.")
                 return
-            record_index = int(selected_item[0])
-            with open(self.filename, mode='r', newline='', encoding='utf-8') as file:
-                all_rows = list(csv.reader(file, delimiter=';'))
-            del all_rows[record_index + 1]
-            with open(self.filename, mode='w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file, delimiter=';')
-                writer.writerows(all_rows)
-            messagebox.showinfo("Success", "Record deleted successfully.")
+            if len(selected_items) > 1 and not messagebox.askyesno(
+                    "Delete Records", f"Delete {len(selected_items)} selected records?", parent=delete_window):
+                return
+            deleted = self.trial_store.delete(selected_items)
+            if deleted == 1:
+                messagebox.showinfo("Success", "Record deleted successfully.")
+            else:
+                messagebox.showinfo("Success", f"{deleted} records deleted successfully.")
             delete_window.destroy()
         delete_button = tk.Button(delete_window, text="Delete Selected", command=confirm_delete,
                                   font=("Arial", 12, "bold"), bg="#f44336", fg="white")
         delete_button.pack(pady=20)
 
+    def compact_data_file(self):
+        if self.compaction_thread and self.compaction_thread.is_alive():
+            messagebox.showinfo("Compact Data File", "Compaction already in progress.")
+            return
+        if self.trial_windows:
+            messagebox.showinfo("Compact Data File", "Close the data windows before compacting the data file.")
+            return
+        def on_done(removed):
+            messagebox.showinfo("Compact Data File", f"Compaction finished. {removed} deleted records removed.")
+        self.start_compaction(on_done)
+
+    def compact_when_idle(self):
+        # Solo fuera de un ensayo, sin tablas de resultados abiertas y si hay
+        # lápidas pendientes
+        busy = (self.running or self.trial_windows
+                or (self.compaction_thread and self.compaction_thread.is_alive()))
+        if not busy and self.trial_store.pending_deletions():
+            self.start_compaction()
+        self.root.after(IDLE_COMPACTION_INTERVAL_MS, self.compact_when_idle)
+
+    def start_compaction(self, on_done=None):
+        def do_compact():
+            try:
+                removed = self.trial_store.compact()
+            except OSError as error:
+                print("Error compactando", self.filename, ":", error)
+                return
+            if on_done:
+                self.root.after(0, lambda: on_done(removed))
+        self.compaction_thread = threading.Thread(target=do_compact, daemon=True)
+        self.compaction_thread.start()
+
     def export_to_excel(self):
-        if not os.path.exists(self.filename):
+        if not self.trial_store.exists():
             messagebox.showwarning("Warning", "No data available to export.")
             return
-        df = pd.read_csv(self.filename, delimiter=';')
-        excel_filename = self.filename.replace('.csv', '.xlsx')
-        df.to_excel(excel_filename, index=False, engine='openpyxl')
-        messagebox.showinfo("Export Successful", f"Data successfully exported to {excel_filename}")
+        if self.export_job and self.export_job.is_running():
+            messagebox.showinfo("Export to Excel", "An export is already in progress.")
+            return
+        export_window = tk.Toplevel(self.root)
+        export_window.title("Export to Excel")
+        export_window.geometry("400x260")
+        export_window.configure(bg="#E8F6F3")
+        per_protocol_var = tk.BooleanVar(value=False)
+        include_hr_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(export_window, text="One sheet per protocol", variable=per_protocol_var,
+                       font=("Arial", 12), bg="#E8F6F3").pack(pady=5, anchor=tk.W, padx=20)
+        tk.Checkbutton(export_window, text="Include HR traces", variable=include_hr_var,
+                       font=("Arial", 12), bg="#E8F6F3").pack(pady=5, anchor=tk.W, padx=20)
+        progress_bar = ttk.Progressbar(export_window, length=340, mode='determinate')
+        progress_bar.pack(pady=10)
+        status_label = tk.Label(export_window, text="", font=("Arial", 10), bg="#E8F6F3")
+        status_label.pack(pady=5)
+        button_frame = tk.Frame(export_window, bg="#E8F6F3")
+        button_frame.pack(pady=10)
+        excel_filename = os.path.splitext(self.filename)[0] + '.xlsx'
+        def poll_export():
+            job = self.export_job
+            while True:
+                try:
+                    message = job.messages.get_nowait()
+                except queue.Empty:
+                    break
+                kind = message[0]
+                if kind == 'progress':
+                    _, done, total, text = message
+                    progress_bar.config(maximum=max(total, 1), value=done)
+                    status_label.config(text=text)
+                    continue
+                if export_window.winfo_exists():
+                    export_window.destroy()
+                if kind == 'done':
+                    messagebox.showinfo("Export Successful", f"Data successfully exported to {message[1]}")
+                elif kind == 'error':
+                    messagebox.showerror("Export Failed", f"Could not export data: {message[1]}")
+                return
+            self.root.after(100, poll_export)
+        def start_export():
+            start_button.config(state=tk.DISABLED)
+            status_label.config(text="Exporting...")
+            self.export_job = ExcelExporter(self.storage, excel_filename,
+                                            per_protocol=per_protocol_var.get(),
+                                            include_hr=include_hr_var.get())
+            self.export_job.start()
+            poll_export()
+        def cancel_export():
+            if self.export_job and self.export_job.is_running():
+                self.export_job.cancel()
+                status_label.config(text="Cancelling...")
+            else:
+                export_window.destroy()
+        start_button = tk.Button(button_frame, text="Export", command=start_export,
+                                 font=("Arial", 12, "bold"), bg="#4CAF50", fg="white", width=10)
+        start_button.grid(row=0, column=0, padx=5)
+        tk.Button(button_frame, text="Cancel", command=cancel_export,
+                  font=("Arial", 12, "bold"), bg="#f44336", fg="white", width=10).grid(row=0, column=1, padx=5)
+        export_window.protocol("WM_DELETE_WINDOW", cancel_export)
 
     # ---------------------------------------------------------------------------
     #                ESCANEAR Y CONECTAR DISPOSITIVOS BLE
     # ---------------------------------------------------------------------------
+    def reconnect_known_device(self):
+        # Conecta directamente con el último pulsómetro usado, sin escanear
+        device = self.known_devices.last_used()
+        if device:
+            print("Reconectando con", device.get("name") or device["address"])
+            self.hr_monitor = self.ble_manager.add_device(device["address"], device.get("name"))
+
     def scan_for_devices(self):
+        if self.scan_window and self.scan_window.winfo_exists():
+            self.scan_window.lift()
+            return
         self.scan_window = tk.Toplevel(self.root)
         self.scan_window.title("Scan for HR Devices")
-        self.scan_window.geometry("400x300")
+        self.scan_window.geometry("450x400")
         self.scan_window.configure(bg="#E8F6F3")
         scan_label = tk.Label(self.scan_window, text="Scanning for devices...", font=("Arial", 12), bg="#E8F6F3")
         scan_label.pack(pady=10)
-        def do_scan():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            devices = loop.run_until_complete(BleakScanner.discover(timeout=5.0))
-            loop.close()
-            self.root.after(0, lambda: self.show_scan_results(devices))
-        threading.Thread(target=do_scan).start()
-
-    def show_scan_results(self, devices):
-        for widget in self.scan_window.winfo_children():
-            widget.destroy()
-        label = tk.Label(self.scan_window, text="Select a device:", font=("Arial", 12, "bold"), bg="#E8F6F3")
-        label.pack(pady=10)
-        listbox = tk.Listbox(self.scan_window, font=("Arial", 12), width=40, height=10)
-        listbox.pack(pady=10)
-        for device in devices:
-            display_text = f"{device.name or 'Unknown'} ({device.address})"
-            listbox.insert(tk.END, display_text)
+        hr_only_var = tk.BooleanVar(value=True)
+        listbox = tk.Listbox(self.scan_window, font=("Arial", 12), width=45, height=10)
+        # address -> [nombre, rssi, anuncia servicio HR]; los conocidos aparecen desde el principio
+        found = {}
+        for device in self.known_devices.devices:
+            found[device["address"]] = [device.get("name"), None, True]
+        shown = []
+        detections = queue.Queue()
+        def on_detection(device, advertisement_data):
+            # Hilo BLE: solo se encola, la lista se actualiza desde Tk
+            detections.put((device.address, device.name or advertisement_data.local_name,
+                            advertisement_data.rssi, advertises_heart_rate(advertisement_data)))
+        def refresh_list():
+            selected = [shown[i] for i in listbox.curselection()]
+            entries = [(address, info) for address, info in found.items()
+                       if info[2] or not hr_only_var.get()]
+            # Mayor RSSI (más cerca) primero; los no detectados todavía al final
+            entries.sort(key=lambda entry: -entry[1][1] if entry[1][1] is not None else float('inf'))
+            shown[:] = [address for address, _ in entries]
+            listbox.delete(0, tk.END)
+            for address, (name, rssi, _) in entries:
+                known = " [known]" if self.known_devices.is_known(address) else ""
+                signal = f"{rssi} dBm" if rssi is not None else "not seen"
+                listbox.insert(tk.END, f"{name or 'Unknown'} ({address}) {signal}{known}")
+            for address in selected:
+                if address in shown:
+                    listbox.selection_set(shown.index(address))
+        def poll_scan():
+            if not self.scan_window.winfo_exists():
+                scan.stop()
+                return
+            changed = False
+            while True:
+                try:
+                    address, name, rssi, hr_service = detections.get_nowait()
+                except queue.Empty:
+                    break
+                info = found.setdefault(address, [name, rssi, hr_service])
+                info[0] = name or info[0]
+                info[1] = rssi
+                info[2] = info[2] or hr_service
+                changed = True
+            if changed:
+                refresh_list()
+            if scan.done():
+                scan_label.config(text="Scan finished. Select a device:")
+            else:
+                self.scan_window.after(200, poll_scan)
         def select_device():
             selection = listbox.curselection()
             if not selection:
                 messagebox.showwarning("Warning", "Please select a device.")
                 return
-            index = selection[0]
-            selected_device = devices[index]
-            if self.hr_monitor:
-                self.hr_monitor.stop()
-            self.hr_monitor = HeartRateMonitor(selected_device.address)
-            self.hr_monitor.start()
-            messagebox.showinfo("Device Selected", f"Connected to {selected_device.name} ({selected_device.address})")
+            address = shown[selection[0]]
+            name = found[address][0]
+            scan.stop()
+            # Los demás dispositivos siguen conectados (sesiones en grupo); este pasa a ser el activo
+            self.hr_monitor = self.ble_manager.add_device(address, name)
+            self.known_devices.remember(address, name)
+            messagebox.showinfo("Device Selected", f"Connected to {name} ({address})")
+            self.scan_window.destroy()
+        def close_window():
+            scan.stop()
             self.scan_window.destroy()
+        tk.Checkbutton(self.scan_window, text="Heart rate devices only", variable=hr_only_var, command=refresh_list,
+                       font=("Arial", 11), bg="#E8F6F3").pack()
+        listbox.pack(pady=10)
         select_button = tk.Button(self.scan_window, text="Select", command=select_device,
                                   font=("Arial", 12, "bold"), bg="#4CAF50", fg="white")
         select_button.pack(pady=10)
+        self.scan_window.protocol("WM_DELETE_WINDOW", close_window)
+        scan = self.ble_manager.start_scan(on_detection)
+        refresh_list()
+        poll_scan()
+
+    def add_simulated_devices(self):
+        # Pulsómetros sintéticos en el mismo bucle que los reales (pruebas de carga sin radio)
+        sim_window = tk.Toplevel(self.root)
+        sim_window.title("Simulated HR Devices")
+        sim_window.geometry("350x260")
+        sim_window.configure(bg="#E8F6F3")
+        fields = [("Devices:", "1"), ("Notifications/s:", "1"), ("Jitter (%):", "5"),
+                  ("Dropouts/min:", "0"), ("Base HR (bpm):", "75")]
+        entries = []
+        for row, (label, default) in enumerate(fields):
+            tk.Label(sim_window, text=label, font=("Arial", 12), bg="#E8F6F3").grid(row=row, column=0, padx=10, pady=5, sticky='e')
+            entry = tk.Entry(sim_window, font=("Arial", 12), width=10)
+            entry.insert(0, default)
+            entry.grid(row=row, column=1, padx=10, pady=5)
+            entries.append(entry)
+        def start_devices():
+            try:
+                count = int(entries[0].get())
+                rate = float(entries[1].get())
+                jitter = float(entries[2].get()) / 100.0
+                dropouts = float(entries[3].get()) / 60.0
+                base_hr = float(entries[4].get())
+            except ValueError:
+                messagebox.showerror("Error", "Please enter numeric values.", parent=sim_window)
+                return
+            if count < 1 or rate <= 0:
+                messagebox.showerror("Error", "Devices and notification rate must be positive.", parent=sim_window)
+                return
+            # Se numera a partir del mayor índice en uso: contar los existentes
+            # reutilizaría el nombre de uno vivo tras desconectar otro anterior
+            existing = max((int(address[4:]) for address in self.ble_manager.monitors
+                            if address.startswith("SIM-") and address[4:].isdigit()), default=0)
+            for i in range(existing + 1, existing + count + 1):
+                source = SimulatedHRSource(f"SIM-{i:02d}", manager=self.ble_manager, name=f"Simulated {i}",
+                                           base_hr=base_hr, rate=rate, jitter=jitter,
+                                           dropout_probability=dropouts)
+                self.ble_manager.add_source(source)
+                if self.hr_monitor is None:
+                    self.hr_monitor = source
+            sim_window.destroy()
+        tk.Button(sim_window, text="Start", command=start_devices,
+                  font=("Arial", 12, "bold"), bg="#4CAF50", fg="white").grid(row=len(fields), column=0, columnspan=2, pady=10)
+
+    def replay_hr_trace(self):
+        filename = filedialog.askopenfilename(
+            parent=self.root, title="Replay HR Trace", initialdir=self.data_directory,
+            filetypes=[("HR traces", "hr_data_*.csv hr_trace_*.bin"), ("All files", "*.*")])
+        if not filename:
+            return
+        speed = simpledialog.askfloat("Replay Speed", "Playback speed (1 = real time):",
+                                      parent=self.root, initialvalue=1.0, minvalue=0.1)
+        if not speed:
+            return
+        self.hr_monitor = self.ble_manager.add_source(ReplayHRSource(filename, manager=self.ble_manager, speed=speed))
+
+    def view_connected_devices(self):
+        devices_window = tk.Toplevel(self.root)
+        devices_window.title("Connected HR Devices")
+        devices_window.geometry("500x350")
+        devices_window.configure(bg="#E8F6F3")
+        tree = ttk.Treeview(devices_window, selectmode='browse')
+        tree['columns'] = ('Device', 'Address', 'HR', 'Active')
+        tree.column('#0', width=0, stretch=tk.NO)
+        tree.column('Device', anchor=tk.W, width=140)
+        tree.column('Address', anchor=tk.W, width=180)
+        tree.column('HR', anchor=tk.CENTER, width=60)
+        tree.column('Active', anchor=tk.CENTER, width=60)
+        tree.heading('#0', text='', anchor=tk.W)
+        tree.heading('Device', text='Device', anchor=tk.W)
+        tree.heading('Address', text='Address', anchor=tk.W)
+        tree.heading('HR', text='HR', anchor=tk.CENTER)
+        tree.heading('Active', text='Active', anchor=tk.CENTER)
+        tree.pack(pady=10, padx=10, fill='both', expand=True)
+        def refresh():
+            if not devices_window.winfo_exists():
+                return
+            monitors = {monitor.address: monitor for monitor in self.ble_manager.devices()}
+            for item in tree.get_children():
+                if item not in monitors:
+                    tree.delete(item)
+            for address, monitor in monitors.items():
+                hr_text = monitor.current_hr if monitor.current_hr is not None else monitor.state
+                values = (monitor.name or 'Unknown', address, hr_text,
+                          "Yes" if monitor is self.hr_monitor else "")
+                if tree.exists(address):
+                    tree.item(address, values=values)
+                else:
+                    tree.insert('', 'end', iid=address, values=values)
+            devices_window.after(1000, refresh)
+        def use_selected():
+            selected_item = tree.selection()
+            if not selected_item:
+                messagebox.showwarning("Warning", "Please select a device.")
+                return
+            self.hr_monitor = self.ble_manager.monitors.get(selected_item[0])
+        def disconnect_selected():
+            selected_item = tree.selection()
+            if not selected_item:
+                messagebox.showwarning("Warning", "Please select a device.")
+                return
+            monitor = self.ble_manager.monitors.get(selected_item[0])
+            if monitor is self.hr_monitor:
+                self.hr_monitor = None
+            self.ble_manager.remove_device(selected_item[0])
+        button_frame = tk.Frame(devices_window, bg="#E8F6F3")
+        button_frame.pack(pady=10)
+        tk.Button(button_frame, text="Use for Trial", command=use_selected,
+                  font=("Arial", 12, "bold"), bg="#4CAF50", fg="white").grid(row=0, column=0, padx=5)
+        tk.Button(button_frame, text="Disconnect", command=disconnect_selected,
+                  font=("Arial", 12, "bold"), bg="#f44336", fg="white").grid(row=0, column=1, padx=5)
+        refresh()
 
     # ---------------------------------------------------------------------------
     #        MÉTODO PARA ACTUALIZAR LA ETIQUETA DE HR EN TIEMPO REAL
     # ---------------------------------------------------------------------------
-    def update_hr_label(self):
+    def update_hr_label(self, scheduled=None, now=None):
         if self.hr_monitor:
-            hr_value = self.hr_monitor.current_hr
-            self.hr_label.config(text=f"HR: {hr_value} bpm")
+            latest = self.hr_monitor.ring.latest()
+            hr_value = latest[2] if latest else None
+            if hr_value is not None:
+                self.hr_label.config(text=f"HR: {hr_value} bpm", fg="#333")
+            else:
+                # Estado de la conexión en lugar de un valor congelado
+                self.hr_label.config(text=f"HR: -- bpm ({self.hr_monitor.state})", fg="#f44336")
         else:
-            self.hr_label.config(text="HR: -- bpm")
-        self.root.after(1000, self.update_hr_label)
+            self.hr_label.config(text="HR: -- bpm", fg="#333")
+
+    # ---------------------------------------------------------------------------
+    #                              DIAGNÓSTICO
+    # ---------------------------------------------------------------------------
+    def show_diagnostics(self):
+        diagnostics_window = tk.Toplevel(self.root)
+        diagnostics_window.title("Diagnostics")
+        diagnostics_window.geometry("760x400")
+        diagnostics_window.configure(bg="#E8F6F3")
+        columns = ('Metric', 'Labels', 'Count', 'Mean (ms)', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'Max (ms)')
+        tree = ttk.Treeview(diagnostics_window, columns=columns, show='headings')
+        for column in columns:
+            tree.heading(column, text=column, anchor=tk.W if column in columns[:2] else tk.CENTER)
+            tree.column(column, width=190 if column == 'Metric' else 110 if column == 'Labels' else 65,
+                        anchor=tk.W if column in columns[:2] else tk.CENTER)
+        tree.pack(pady=10, padx=10, fill='both', expand=True)
+        def milliseconds(value):
+            return f"{value * 1000:.2f}" if value is not None else "--"
+        def refresh():
+            if not diagnostics_window.winfo_exists():
+                return
+            tree.delete(*tree.get_children())
+            for snapshot in METRICS.snapshot():
+                labels = ", ".join(f"{key}={value}" for key, value in snapshot["labels"].items())
+                tree.insert('', 'end', values=(
+                    snapshot["name"], labels, snapshot["count"], milliseconds(snapshot["mean"]),
+                    milliseconds(snapshot["p50"]), milliseconds(snapshot["p95"]),
+                    milliseconds(snapshot["p99"]), milliseconds(snapshot["max"])))
+            for counter in METRICS.counter_snapshot():
+                labels = ", ".join(f"{key}={value}" for key, value in counter["labels"].items())
+                tree.insert('', 'end', values=(counter["name"], labels, counter["value"]) + ("--",) * 5)
+            diagnostics_window.after(1000, refresh)
+        def save():
+            filename = filedialog.asksaveasfilename(
+                parent=diagnostics_window, title="Save Metrics", defaultextension=".json",
+                filetypes=[("JSON", "*.json"), ("Prometheus text", "*.prom")])
+            if not filename:
+                return
+            try:
+                METRICS.write(filename)
+            except OSError as error:
+                messagebox.showerror("Error", f"Could not save the metrics: {error}", parent=diagnostics_window)
+        def reset():
+            METRICS.reset()
+            tree.delete(*tree.get_children())
+        button_frame = tk.Frame(diagnostics_window, bg="#E8F6F3")
+        button_frame.pack(pady=10)
+        tk.Button(button_frame, text="Save", command=save,
+                  font=("Arial", 12, "bold"), bg="#4CAF50", fg="white").grid(row=0, column=0, padx=5)
+        tk.Button(button_frame, text="Reset", command=reset,
+                  font=("Arial", 12, "bold"), bg="#f44336", fg="white").grid(row=0, column=1, padx=5)
+        refresh()
 
     # ---------------------------------------------------------------------------
     #                                SALIR
     # ---------------------------------------------------------------------------
     def confirm_exit(self):
         if messagebox.askyesno("Exit", "Are you sure you want to exit the application?"):
-            if self.hr_monitor:
-                self.hr_monitor.stop()
+            self.ble_manager.shutdown()
+            if self.hr_writer:
+                self.hr_writer.close()
+            if self.compaction_thread:
+                self.compaction_thread.join()
+            if self.export_job and self.export_job.is_running():
+                self.export_job.cancel()
+                self.export_job.thread.join()
+            self.storage.close()
+            if METRICS_FILE:
+                try:
+                    METRICS.write(METRICS_FILE)
+                except OSError as error:
+                    print("Error escribiendo", METRICS_FILE, ":", error)
             self.root.quit()
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "analyze":
+        sys.exit(analyze_main(sys.argv[2:]))
     root = tk.Tk()
     app = StopwatchApp(root)
     root.mainloop()